@@ -1,12 +1,30 @@
 import os
 import json
 import time
+import html
+import re
+import argparse
+import hashlib
+import queue
+import threading
+import mmap
+import contextlib
+import contextvars
+import random
+import sqlite3
+import socket
+import shutil
+import subprocess
+import fnmatch
+import email.utils
 import dropbox
+import requests
 import google.generativeai as genai
 import markdown
 import mimetypes
 
 from datetime import datetime, timedelta
+from google.api_core import exceptions as google_exceptions
 from google.generativeai import GenerationConfig
 
 # --- Configuration ---
@@ -25,6 +43,11 @@ DROPBOX_WATCH_FOLDER_PATH = '/Omni/WW/Entities/DC. Omni Coaching/Meetings/Record
 # <<< --- **VERIFY/CONFIGURE THIS OUTPUT FOLDER PATH** --- >>>
 DROPBOX_OUTPUT_FOLDER_PATH = '/Omni/WW/Entities/DC. Omni Coaching/Meetings/Descriptions'
 
+# The path to the folder in your Dropbox account where cached transcripts and visual notes
+# (keyed by the video's Dropbox content hash) are stored when the transcript cache is enabled.
+# <<< --- **VERIFY/CONFIGURE THIS TRANSCRIPT FOLDER PATH** --- >>>
+DROPBOX_TRANSCRIPT_FOLDER_PATH = '/Omni/WW/Entities/DC. Omni Coaching/Meetings/Transcripts'
+
 # List of video file extensions to look for (case-insensitive comparison will be used)
 # <<< --- **VERIFY/CONFIGURE THIS LIST** --- >>>
 VIDEO_EXTENSIONS = ['.mp4', '.mov', '.avi', '.mkv', '.webm', '.flv']
@@ -38,6 +61,158 @@ GEMINI_CONFIG_PATH = 'gemini_config.json'
 GEMINI_PROMPT_TEMPLATE_PATH = 'video_description_prompt_template.md'
 GEMINI_EXAMPLE_OUTPUT_PATH = 'description_example_output.md'
 
+# --- Structured (JSON) Output ---
+# When "output_format" in gemini_config.json is "json", Gemini is asked to return JSON
+# matching this schema and the markdown/HTML outputs are rendered locally from it.
+OUTPUT_FORMAT_MARKDOWN = 'markdown'
+OUTPUT_FORMAT_JSON = 'json'
+DESCRIPTION_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "summary": {"type": "string"},
+        "key_processes": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "title": {"type": "string"},
+                    "description": {"type": "string"},
+                },
+                "required": ["title", "description"],
+            },
+        },
+        "takeaways": {"type": "array", "items": {"type": "string"}},
+    },
+    "required": ["summary", "key_processes", "takeaways"],
+}
+JSON_OUTPUT_PROMPT_SUFFIX = (
+    "\n\nReturn the description as JSON matching the response schema instead of markdown: "
+    "put the **Summary:** paragraph in \"summary\", each numbered **Key Processes:** item in "
+    "\"key_processes\" as a \"title\" and \"description\" pair, and each **Takeaways:** bullet "
+    "in \"takeaways\". Do not include markdown formatting inside the JSON values."
+)
+
+# --- Section Validation and Repair ---
+# Section headers are bold lines like '**Summary:**' in description_example_output.md.
+SECTION_HEADER_PATTERN = re.compile(r'^\s*(?:#+\s*)?\*\*\s*([^*\n]+?)\s*:?\s*\*\*\s*:?\s*$', re.MULTILINE)
+# Maps example section headers to the fields of DESCRIPTION_RESPONSE_SCHEMA (JSON output format).
+SECTION_SCHEMA_KEYS = {"Summary": "summary", "Key Processes": "key_processes", "Takeaways": "takeaways"}
+SECTION_REPAIR_PROMPT_TEMPLATE = (
+    "A structured description was generated for the attached video, but the following sections are "
+    "missing or were cut short: {sections}\n\n"
+    "Analyze the video content and generate ONLY those sections, using past tense and the exact header "
+    "formatting of the EXAMPLE TEXT below. Do not repeat any other section and do not add introductory text.\n\n"
+    "EXAMPLE TEXT:\n{example}\n\n"
+    "DESCRIPTION GENERATED SO FAR:\n{description}"
+)
+
+# --- Transcript Cache ---
+# Optional first pass that stores a timestamped transcript and visual notes per video so later
+# prompt versions can run as text-only requests instead of re-sending the video.
+TRANSCRIPT_CACHE_LOCAL_DIR = 'transcript_cache'
+TRANSCRIPT_EXTRACTION_PROMPT = (
+    "Transcribe all speech in this video. Prefix every utterance with its start timestamp in [HH:MM:SS] "
+    "format and start a new line whenever the speaker changes or a new sentence begins. Refer to speakers "
+    "generically (e.g. 'Speaker 1'). Output only the transcript."
+)
+VISUAL_NOTES_EXTRACTION_PROMPT = (
+    "Describe what is shown on screen in this video as timestamped notes. For each distinct step, prefix "
+    "the note with its start timestamp in [HH:MM:SS] format and describe the software, menus, settings, "
+    "drawings and actions that are visible, including anything demonstrated but not spoken aloud. "
+    "Output only the notes as a bulleted list."
+)
+TRANSCRIPT_SOURCE_PROMPT_PREFIX = (
+    "The video is not attached. Instead, its timestamped TRANSCRIPT and VISUAL NOTES are provided below the "
+    "instructions. Treat them as the video content.\n\n"
+)
+TRANSCRIPT_SOURCE_TEMPLATE = "TRANSCRIPT:\n{transcript}\n\nVISUAL NOTES:\n{visual_notes}"
+
+# --- Pipeline State ---
+PIPELINE_STATE_DB_FILE = 'pipeline_state.sqlite3'
+# Local journal of changed job rows, shipped to Dropbox as a segment at the end of each run
+PIPELINE_STATE_JOURNAL_FILE = 'pipeline_state.journal.jsonl'
+# Legacy flat list of processed paths, imported into the state store on first use
+PROCESSED_FILES_STATE_FILE = 'processed_files.json'
+STATE_BACKEND_LOCAL = 'local'
+STATE_BACKEND_DROPBOX = 'dropbox'
+# App-private location of the state database when the Dropbox state backend is used
+DEFAULT_STATE_DROPBOX_PATH = '/.video-content-extractor/pipeline_state.sqlite3'
+# Scheduling of the videos found in a run
+SCHEDULER_POLICY_SJF = 'sjf'
+SCHEDULER_POLICY_FIFO = 'fifo'
+# Fallback estimates before there is throughput history
+DEFAULT_SECONDS_PER_MEDIA_SECOND = 0.25
+DEFAULT_SECONDS_PER_BYTE = 1 / (2 * 1024 * 1024)
+
+# What an overlapping run does when another run holds the run lock
+RUN_LOCK_ON_CONFLICT_EXIT = 'exit'
+RUN_LOCK_ON_CONFLICT_UNLEASED = 'unleased' # Continue, but only with videos not leased in the work queue
+# Stages a video passes through (the job row records the last one completed)
+STAGE_DISCOVERED = 'discovered'
+STAGE_DOWNLOADED = 'downloaded'
+STAGE_GEMINI_UPLOADED = 'gemini_uploaded'
+STAGE_GEMINI_ACTIVE = 'gemini_active'
+STAGE_GENERATED = 'generated'
+STAGE_RENDERED = 'rendered'
+STAGE_PUBLISHED = 'published'
+STATUS_PENDING = 'pending'
+STATUS_RUNNING = 'running'
+STATUS_FAILED = 'failed'
+STATUS_DONE = 'done'
+
+# --- Prompt Versioning ---
+# Every published description is stamped with a hash of the prompt template, example output and
+# these gemini_config.json keys, so outputs produced by older prompt versions can be found later.
+PROMPT_VERSION_CONFIG_KEYS = ("model_name", "generation_config", "output_format")
+OUTPUT_STAMP_MARKER = 'video-content-extractor-stamp:'
+OUTPUT_STAMP_PATTERN = re.compile(r'<!--\s*' + re.escape(OUTPUT_STAMP_MARKER) + r'\s*(\{.*?\})\s*-->', re.DOTALL)
+OUTPUT_STAMP_PROPERTY_TEMPLATE_NAME = 'VideoDescriptionStamp'
+OUTPUT_STAMP_FIELDS = ("prompt_version", "model_name", "source_content_hash", "source_path")
+
+# --- Dropbox Uploads ---
+# Dropbox upload sessions need every chunk but the last to be a multiple of 4 MiB.
+DROPBOX_UPLOAD_CHUNK_GRANULARITY = 4 * 1024 * 1024
+# Downloads are streamed to disk in chunks of this size
+DROPBOX_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Dropbox content_hash is computed over 4 MiB blocks
+DROPBOX_CONTENT_HASH_BLOCK_SIZE = 4 * 1024 * 1024
+
+# --- Resumable Gemini Uploads ---
+GEMINI_UPLOAD_ENDPOINT = 'https://generativelanguage.googleapis.com/upload/v1beta/files'
+# Every chunk except the last must be a multiple of 256 KiB
+RESUMABLE_UPLOAD_CHUNK_GRANULARITY = 256 * 1024
+RESUMABLE_UPLOAD_CHUNK_TIMEOUT_SECONDS = 300
+
+# --- Inline Video Fast Path ---
+# Videos at or below inline_video.max_bytes are sent as inline data in generate_content instead of
+# through the Files API. Gemini caps the whole request at 20 MB and inline data is base64 encoded
+# (4/3 larger), so the default leaves room for the prompt.
+INPUT_PATH_INLINE = 'inline'
+INPUT_PATH_FILES_API = 'files_api'
+INPUT_PATH_TRANSCRIPT = 'cached_transcript'
+DEFAULT_INLINE_VIDEO_MAX_BYTES = 14 * 1024 * 1024
+
+# --- Hedged Generation ---
+# How many recent generate_content latencies from the state store decide when a slow call gets a hedge request.
+GENERATION_LATENCY_HISTORY_SIZE = 200
+
+# --- Rate Limiting ---
+# Every Gemini and Dropbox call goes through a per-API limiter (see call_remote).
+REMOTE_API_GEMINI = 'gemini'
+REMOTE_API_DROPBOX = 'dropbox'
+# Wait used when a rate-limited response carries no usable Retry-After
+DEFAULT_RATE_LIMIT_BACKOFF_SECONDS = 30
+# Token estimate for a video part before the response reports the real usage (about 10 minutes of video)
+DEFAULT_GEMINI_VIDEO_PART_TOKENS = 180000
+# State store settings: concurrency limits learned by the adaptive controller (the starting point of the next
+# run) and circuit breaker states (so an outage is not rediscovered every run)
+CONCURRENCY_LIMITS_SETTING = 'concurrency_limits'
+CIRCUIT_BREAKERS_SETTING = 'circuit_breakers'
+CIRCUIT_CLOSED = 'closed'
+CIRCUIT_OPEN = 'open'
+CIRCUIT_HALF_OPEN = 'half_open'
+
 # Check for required environment variables early
 if not DROPBOX_ACCESS_TOKEN:
     print("Error: DROPBOX_ACCESS_TOKEN environment variable is not set.")
@@ -46,6 +221,33 @@ if not GEMINI_API_KEY:
     print("Error: GEMINI_API_KEY environment variable is not set.")
     exit(1)
 
+# --- Command Line ---
+# With no command the script runs the scheduled watch-folder pass ("run").
+arg_parser = argparse.ArgumentParser(description="Generate video descriptions for new Dropbox recordings with Gemini.")
+def parse_shard(value):
+    """Parses an --shard value "i/N" (0 <= i < N) into (i, N)."""
+    try:
+        shard_index, shard_count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"'{value}' is not of the form i/N")
+    if shard_count < 1 or not 0 <= shard_index < shard_count:
+        raise argparse.ArgumentTypeError(f"shard index must be in 0..N-1 and N >= 1 (got {value})")
+    return shard_index, shard_count
+
+arg_parser.add_argument("--shard", type=parse_shard, default=(0, 1), metavar="i/N", help="Only handle videos whose file-ID hash falls in shard i of N (0-based), with separate state per shard.")
+arg_parser.add_argument("--worker-id", default=None, help="Identity used for work-queue leases (default: hostname-pid). Reusing it after a crash reclaims its leases at once.")
+subparsers = arg_parser.add_subparsers(dest="command")
+subparsers.add_parser("run", help="Process new videos in the watch folder (default).")
+reprocess_parser = subparsers.add_parser("reprocess", help="Regenerate published descriptions.")
+reprocess_parser.add_argument("--stale", action="store_true", required=True, help="Select descriptions stamped with an older prompt version.")
+reprocess_parser.add_argument("--limit", type=int, default=None, help="Maximum number of videos to reprocess in this run (default from config).")
+reprocess_parser.add_argument("--min-interval", type=float, default=None, help="Minimum seconds between starting two reprocessing jobs (default from config).")
+status_parser = subparsers.add_parser("status", help="Print a job status report merged across all shards.")
+status_parser.add_argument("--shards", type=int, default=None, help="Number of shards to merge (default: N from --shard).")
+CLI_ARGS = arg_parser.parse_args()
+CLI_ARGS.command = CLI_ARGS.command or "run"
+SHARD_INDEX, SHARD_COUNT = CLI_ARGS.shard
+
 # --- Helper Functions ---
 
 def read_json_config(config_path):
@@ -92,11 +294,11 @@ def download_file_from_dropbox(dbx_client, dropbox_path, local_path):
         if local_dir:
            os.makedirs(local_dir, exist_ok=True)
 
-        with open(local_path, "wb") as f:
-            metadata, res = dbx_client.files_download(path=dropbox_path)
-            f.write(res.content)
+        metadata = dbx_client.download_to_file(dropbox_path, local_path)
         print(f"Successfully downloaded '{dropbox_path}' ({metadata.size} bytes)")
         return True
+    except CircuitOpenError:
+        raise
     except dropbox.exceptions.ApiError as e:
         print(f"Error downloading file {dropbox_path}: {e}")
         return False
@@ -104,19 +306,65 @@ def download_file_from_dropbox(dbx_client, dropbox_path, local_path):
         print(f"An unexpected error occurred during download of {dropbox_path}: {e}")
         return False
 
-def upload_file_to_dropbox(dbx_client, local_path, dropbox_target_path):
-    """Uploads a local file to a specific path in Dropbox."""
+@contextlib.contextmanager
+def mapped_file(local_path):
+    """Memory-maps a local file read-only for upload, so chunks are read from the page cache.
+
+    Yields the mmap (or b'' for an empty file, which cannot be mapped). Slicing it copies only
+    the requested chunk, never the whole file.
+    """
+    with open(local_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b''
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if hasattr(mapped, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            yield mapped
+
+def iter_file_chunks(source, chunk_size, start_offset=0):
+    """Yields (offset, chunk_bytes) pairs from a mapped file, starting at start_offset."""
+    for offset in range(start_offset, len(source), chunk_size):
+        yield offset, source[offset:offset + chunk_size]
+
+def upload_file_to_dropbox(dbx_client, local_path, dropbox_target_path, property_groups=None):
+    """Uploads a local file to a specific path in Dropbox, optionally attaching file property groups.
+
+    The file is memory-mapped. Files up to one chunk go in a single files_upload call; larger
+    files are streamed chunk by chunk through an upload session.
+    """
     file_name = os.path.basename(local_path)
     print(f"Uploading '{file_name}' from '{local_path}' to Dropbox path '{dropbox_target_path}'...")
 
     try:
-        with open(local_path, 'rb') as f:
-            dbx_client.files_upload(
-                f.read(),
-                dropbox_target_path,
-                mode=dropbox.files.WriteMode('overwrite'),
-                mute=True
-            )
+        with mapped_file(local_path) as source:
+            if len(source) <= DROPBOX_UPLOAD_CHUNK_SIZE:
+                dbx_client.files_upload(
+                    source[:],
+                    dropbox_target_path,
+                    mode=dropbox.files.WriteMode('overwrite'),
+                    mute=True,
+                    property_groups=property_groups
+                )
+            else:
+                cursor = None
+                for offset, chunk in iter_file_chunks(source, DROPBOX_UPLOAD_CHUNK_SIZE):
+                    if cursor is None:
+                        session = dbx_client.files_upload_session_start(chunk)
+                        cursor = dropbox.files.UploadSessionCursor(session_id=session.session_id, offset=len(chunk))
+                    else:
+                        dbx_client.files_upload_session_append_v2(chunk, cursor)
+                        cursor.offset = offset + len(chunk)
+                dbx_client.files_upload_session_finish(
+                    b'',
+                    cursor,
+                    dropbox.files.CommitInfo(
+                        path=dropbox_target_path,
+                        mode=dropbox.files.WriteMode('overwrite'),
+                        mute=True,
+                        property_groups=property_groups
+                    )
+                )
         print(f"Successfully uploaded '{file_name}' to Dropbox.")
         return True
     except dropbox.exceptions.ApiError as e:
@@ -126,6 +374,3054 @@ def upload_file_to_dropbox(dbx_client, local_path, dropbox_target_path):
         print(f"An unexpected error occurred during upload of '{file_name}' to Dropbox: {e}")
         return False
 
+def parse_description_json(response_text):
+    """Parses and validates a JSON description against DESCRIPTION_RESPONSE_SCHEMA. Returns a dict or None."""
+    try:
+        data = json.loads(response_text)
+    except (json.JSONDecodeError, TypeError) as e:
+        print(f"Error: Gemini response is not valid JSON: {e}")
+        return None
+
+    if not isinstance(data, dict):
+        print("Error: Gemini JSON response is not an object.")
+        return None
+
+    summary = data.get("summary")
+    key_processes = data.get("key_processes")
+    takeaways = data.get("takeaways")
+    if not isinstance(summary, str):
+        print("Error: Gemini JSON response has a missing or malformed 'summary'.")
+        return None
+    if not isinstance(key_processes, list) or not all(
+        isinstance(p, dict) and isinstance(p.get("title"), str) and isinstance(p.get("description"), str)
+        for p in key_processes
+    ):
+        print("Error: Gemini JSON response has a missing or malformed 'key_processes' list.")
+        return None
+    if not isinstance(takeaways, list) or not all(isinstance(t, str) for t in takeaways):
+        print("Error: Gemini JSON response has a missing or malformed 'takeaways' list.")
+        return None
+
+    return {
+        "summary": summary.strip(),
+        "key_processes": [{"title": p["title"].strip(), "description": p["description"].strip()} for p in key_processes],
+        "takeaways": [t.strip() for t in takeaways if t.strip()],
+    }
+
+def render_description_markdown(description):
+    """Renders a parsed JSON description to markdown in the layout of description_example_output.md."""
+    lines = ["**Summary:**", "", description["summary"], "", "**Key Processes:**", ""]
+    for index, process in enumerate(description["key_processes"], start=1):
+        lines.append(f"{index}. **{process['title']}:** {process['description']}")
+    lines += ["", "**Takeaways:**", ""]
+    for takeaway in description["takeaways"]:
+        lines.append(f"- {takeaway}")
+    return "\n".join(lines) + "\n"
+
+def render_description_html(description):
+    """Renders a parsed JSON description to HTML (same structure markdown.markdown produces for the markdown layout)."""
+    parts = ["<p><strong>Summary:</strong></p>", f"<p>{html.escape(description['summary'])}</p>", "<p><strong>Key Processes:</strong></p>", "<ol>"]
+    for process in description["key_processes"]:
+        parts.append(f"<li><strong>{html.escape(process['title'])}:</strong> {html.escape(process['description'])}</li>")
+    parts += ["</ol>", "<p><strong>Takeaways:</strong></p>", "<ul>"]
+    for takeaway in description["takeaways"]:
+        parts.append(f"<li>{html.escape(takeaway)}</li>")
+    parts.append("</ul>")
+    return "\n".join(parts)
+
+def extract_candidate_text(response):
+    """Inspects the first response candidate for safety blocking and extracts its text.
+
+    Returns (response_text, content_blocked, finish_reason_str). response_text is None when
+    the candidate was blocked or no text could be extracted.
+    """
+    response_text = None
+    content_blocked = False # Flag to track if content was blocked by safety filters
+    finish_reason_str = ''
+
+    if not (response and hasattr(response, 'candidates') and response.candidates):
+        return response_text, content_blocked, finish_reason_str
+
+    candidate = response.candidates[0]
+
+    # --- Check finish reason - often indicates filtering ---
+    # Use string comparison for robustness across library versions
+    if hasattr(candidate, 'finish_reason'):
+        finish_reason_str = str(candidate.finish_reason) # Convert Enum to string
+        print(f"Candidate finish reason: {finish_reason_str}")
+        # Common finish reasons for filtering include SAFETY, RECITATION, OTHER
+        if 'SAFETY' in finish_reason_str or 'RECITATION' in finish_reason_str:
+            print("Candidate finished due to safety or recitation policy.")
+            content_blocked = True
+            # Log safety ratings if available, for detail
+            if hasattr(candidate, 'safety_ratings') and candidate.safety_ratings:
+                print("Safety ratings:")
+                for rating in candidate.safety_ratings:
+                    # Check if probability is AT_LEAST_MEDIUM or higher (usually indicates potential issue)
+                    # Value 4=AT_LEAST_MEDIUM, 5=HARM_BLOCKED (for probability Enum)
+                    prob_value = rating.probability # This is an Enum value
+                    print(f"  - {rating.category}: {prob_value} (Probability Enum Value)")
+                    if prob_value >= 4: # Check against Enum value >= AT_LEAST_MEDIUM
+                        print("    (Likely blocked due to high probability)")
+
+    # --- If not blocked by finish reason, check individual ratings more thoroughly ---
+    # This catches cases where finish_reason isn't explicitly safety but ratings are high
+    if not content_blocked and hasattr(candidate, 'safety_ratings') and candidate.safety_ratings:
+        print("Checking individual safety ratings (second pass)...")
+        for rating in candidate.safety_ratings:
+            prob_value = rating.probability # This is an Enum value
+            if prob_value >= 4: # Check if probability is AT_LEAST_MEDIUM or higher
+                print(f"  - {rating.category}: {prob_value} (Probability Enum Value) (Potential block indicated)")
+                content_blocked = True # Mark as blocked if any rating is AT_LEAST_MEDIUM or higher
+        if content_blocked:
+            print("Content marked as blocked due to high safety rating probabilities.")
+
+    # --- If not blocked, attempt to extract text ---
+    if not content_blocked and hasattr(candidate, 'content') and candidate.content and hasattr(candidate.content, 'parts') and candidate.content.parts:
+        try:
+            response_text = ''.join(p.text for p in candidate.content.parts if hasattr(p, 'text'))
+        except Exception as text_extract_e:
+            print(f"Warning: Error extracting text from response parts: {text_extract_e}")
+            response_text = None # Ensure None if extraction fails
+
+    return response_text, content_blocked, finish_reason_str
+
+def parse_section_headers(example_text):
+    """Returns the bold section headers (e.g. 'Summary' for '**Summary:**') in the order they appear in the example."""
+    return [match.strip() for match in SECTION_HEADER_PATTERN.findall(example_text)]
+
+def split_description_sections(description_text):
+    """Splits a markdown description into an ordered dict of section header -> section body."""
+    sections = {}
+    current_header = None
+    body_lines = []
+    for line in description_text.splitlines():
+        header_match = SECTION_HEADER_PATTERN.match(line)
+        if header_match:
+            if current_header is not None:
+                sections[current_header] = '\n'.join(body_lines).strip()
+            current_header = header_match.group(1).strip()
+            body_lines = []
+        elif current_header is not None:
+            body_lines.append(line)
+    if current_header is not None:
+        sections[current_header] = '\n'.join(body_lines).strip()
+    return sections
+
+def find_missing_sections(description_text, required_headers, truncated=False):
+    """Returns the required section headers that are absent or empty in the description.
+
+    When the response was cut short (finish reason MAX_TOKENS), the last section present is
+    also treated as missing since its body is likely incomplete.
+    """
+    sections = split_description_sections(description_text)
+    present = {header.lower(): body for header, body in sections.items()}
+    missing = [header for header in required_headers if not present.get(header.lower())]
+    if truncated and sections:
+        last_header = list(sections)[-1]
+        for header in required_headers:
+            if header.lower() == last_header.lower() and header not in missing:
+                missing.append(header)
+    return [header for header in required_headers if header in missing]
+
+def merge_description_sections(description_text, repair_text, required_headers):
+    """Merges repaired sections into a description, keeping the section order of the example."""
+    original = {header.lower(): body for header, body in split_description_sections(description_text).items()}
+    repaired = {header.lower(): body for header, body in split_description_sections(repair_text).items()}
+    blocks = []
+    for header in required_headers:
+        body = repaired.get(header.lower()) or original.get(header.lower(), '')
+        blocks.append(f"**{header}:**\n\n{body}")
+    return '\n\n'.join(blocks) + '\n'
+
+def repair_missing_sections(model, source_parts, file_name, response_text, description_data, truncated):
+    """Validates a generated description against the example's section headers and repairs gaps.
+
+    Missing (or truncated) sections are requested in a small follow-up call against the same
+    source parts (e.g. the already-uploaded Gemini file) and merged into the description, so
+    the video does not have to be regenerated from scratch. Returns (response_text, description_data).
+    """
+    missing_sections = find_missing_sections(response_text, REQUIRED_SECTION_HEADERS, truncated)
+    if not missing_sections:
+        return response_text, description_data
+
+    print(f"Description for {file_name} is missing or has incomplete sections: {', '.join(missing_sections)}")
+    if not SECTION_REPAIR_ENABLED:
+        print("Section repair is disabled in config. Keeping description as generated.")
+        return response_text, description_data
+
+    for attempt in range(1, SECTION_REPAIR_MAX_ATTEMPTS + 1):
+        print(f"Requesting repair of {len(missing_sections)} section(s) for {file_name} (attempt {attempt}/{SECTION_REPAIR_MAX_ATTEMPTS})...")
+        repair_prompt = SECTION_REPAIR_PROMPT_TEMPLATE.format(
+            sections=', '.join(f"**{header}:**" for header in missing_sections),
+            example=example_output_content,
+            description=response_text,
+        )
+        try:
+            if description_data is not None:
+                # JSON output format: ask for just the missing schema fields and merge them into the data
+                missing_keys = [SECTION_SCHEMA_KEYS[h] for h in missing_sections if h in SECTION_SCHEMA_KEYS]
+                if not missing_keys:
+                    print("Warning: Missing sections have no counterpart in the JSON schema. Cannot repair in JSON mode.")
+                    break
+                repair_schema = {
+                    "type": "object",
+                    "properties": {key: DESCRIPTION_RESPONSE_SCHEMA["properties"][key] for key in missing_keys},
+                    "required": missing_keys,
+                }
+                repair_config = GenerationConfig(**dict(raw_gen_config, response_schema=repair_schema))
+                repair_response = generate_content(model, [repair_prompt + JSON_OUTPUT_PROMPT_SUFFIX] + source_parts, repair_config)
+                repair_text, repair_blocked, _ = extract_candidate_text(repair_response)
+                if not repair_text or repair_blocked:
+                    print("Warning: Section repair returned no usable content.")
+                    continue
+                try:
+                    repaired_fields = json.loads(repair_text)
+                except json.JSONDecodeError as e:
+                    print(f"Warning: Section repair response is not valid JSON: {e}")
+                    continue
+                merged_data = parse_description_json(json.dumps(dict(description_data, **{
+                    key: repaired_fields.get(key) for key in missing_keys if key in repaired_fields
+                })))
+                if merged_data is None:
+                    continue
+                description_data = merged_data
+                response_text = render_description_markdown(description_data)
+            else:
+                repair_response = generate_content(model, [repair_prompt] + source_parts, GEMINI_GENERATION_CONFIG)
+                repair_text, repair_blocked, _ = extract_candidate_text(repair_response)
+                if not repair_text or repair_blocked:
+                    print("Warning: Section repair returned no usable content.")
+                    continue
+                response_text = merge_description_sections(response_text, repair_text, REQUIRED_SECTION_HEADERS)
+        except Exception as repair_e:
+            print(f"Error during section repair request for {file_name}: {repair_e}")
+            continue
+
+        missing_sections = find_missing_sections(response_text, REQUIRED_SECTION_HEADERS)
+        if not missing_sections:
+            print(f"Section repair succeeded for {file_name}.")
+            return response_text, description_data
+
+    print(f"Warning: Description for {file_name} still has missing sections after repair: {', '.join(missing_sections)}")
+    return response_text, description_data
+
+# --- Rate Limiting ---
+# Each API has a request bucket and (for Gemini) a token bucket, refilled per minute from the
+# rate_limits config. Callers reserve from the buckets and sleep off any shortfall, so bursts
+# from several threads are spread out instead of tripping the quota. A 429 pauses every caller
+# of that API for its Retry-After and the call is retried, instead of failing the video or run.
+
+class TokenBucket:
+    """A token bucket that refills at rate_per_minute up to capacity.
+
+    Reservations may push it below zero; the debt is the time later callers have to wait.
+    """
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate_per_second = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self.level = float(self.capacity)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.rate_per_second)
+        self.updated_at = now
+
+    def reserve(self, amount):
+        """Takes amount from the bucket and returns how many seconds the caller must wait before using it."""
+        with self.lock:
+            self._refill()
+            self.level -= amount
+            return max(0.0, -self.level / self.rate_per_second)
+
+    def adjust(self, amount):
+        """Takes (or with a negative amount, returns) tokens without waiting, e.g. to settle an estimate."""
+        with self.lock:
+            self._refill()
+            self.level = min(self.capacity, self.level - amount)
+
+class ApiRateLimiter:
+    """Request and token buckets for one remote API, plus a shared pause for Retry-After."""
+
+    def __init__(self, name, requests_per_minute=None, tokens_per_minute=None):
+        self.name = name
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+        self.stats = {"calls": 0, "throttled_calls": 0, "throttled_seconds": 0.0, "rate_limited": 0, "retries": 0, "retries_exhausted": 0}
+
+    def acquire(self, tokens=0):
+        """Blocks until the call fits in the request and token budgets."""
+        waits = [self.paused_until - time.monotonic()]
+        if self.request_bucket:
+            waits.append(self.request_bucket.reserve(1))
+        if self.token_bucket and tokens:
+            waits.append(self.token_bucket.reserve(tokens))
+        wait = max(waits)
+        with self.lock:
+            self.stats["calls"] += 1
+            if wait > 0:
+                self.stats["throttled_calls"] += 1
+                self.stats["throttled_seconds"] += wait
+        if wait > 0:
+            time.sleep(wait)
+
+    def settle_tokens(self, estimated_tokens, used_tokens):
+        """Corrects the token bucket once a response reports its real usage."""
+        if self.token_bucket and used_tokens is not None:
+            self.token_bucket.adjust(used_tokens - estimated_tokens)
+
+    def pause(self, seconds):
+        """Holds back every caller of this API for the given time (from Retry-After)."""
+        with self.lock:
+            self.stats["rate_limited"] += 1
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+def parse_retry_after(value):
+    """Parses a Retry-After header (seconds or HTTP date) into seconds, or None."""
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def rate_limit_retry_after(outcome):
+    """Returns the seconds to wait if a call result or exception is a rate limit (429), else None."""
+    if isinstance(outcome, dropbox.exceptions.RateLimitError):
+        return outcome.backoff if outcome.backoff is not None else DEFAULT_RATE_LIMIT_BACKOFF_SECONDS
+    if isinstance(outcome, (google_exceptions.TooManyRequests, google_exceptions.ResourceExhausted)):
+        response = outcome.response
+    elif isinstance(outcome, (requests.Response, requests.HTTPError)):
+        response = outcome if isinstance(outcome, requests.Response) else outcome.response
+        if response is None or response.status_code != 429:
+            return None
+    else:
+        return None
+    headers = getattr(response, 'headers', None) or {}
+    retry_after = parse_retry_after(headers.get('Retry-After'))
+    return retry_after if retry_after is not None else DEFAULT_RATE_LIMIT_BACKOFF_SECONDS
+
+def estimate_gemini_tokens(contents):
+    """Rough token count of a generate_content request: ~4 characters per token for text, a fixed budget per video part."""
+    return sum(len(part) // 4 if isinstance(part, str) else RATE_LIMIT_GEMINI_VIDEO_PART_TOKENS for part in contents)
+
+def gemini_used_tokens(response):
+    """Returns the total token count reported by a generate_content response, or None."""
+    usage = getattr(response, 'usage_metadata', None)
+    return getattr(usage, 'total_token_count', None) if usage is not None else None
+
+# --- Adaptive Concurrency ---
+# The number of calls in flight per API is capped by a limit that adapts AIMD-style: it grows by
+# about one slot per window of successful calls that used the whole limit, and is cut
+# multiplicatively on a 429, a 5xx or a latency spike (several times the operation's usual
+# latency). Calls that started before a cut do not cut it again, so one burst of errors counts
+# as a single congestion signal. The learned limits carry over to the next run.
+
+class AdaptiveConcurrencyLimit:
+    """AIMD limit on the number of in-flight calls to one remote API."""
+
+    def __init__(self, name, initial_limit, min_limit, max_limit):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(min(max(initial_limit, min_limit), max_limit))
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.latency_baselines = {} # Operation -> (smoothed latency in seconds, samples)
+        self.last_decrease_at = 0.0
+        self.stats = {"peak_in_flight": 0, "waits": 0, "increases": 0, "decreases": 0, "lowest_limit": self.limit, "highest_limit": self.limit}
+
+    def reset_limit(self, limit):
+        """Starts over from a given limit (e.g. the one learned by the previous run), within the bounds."""
+        with self.condition:
+            self.limit = float(min(max(limit, self.min_limit), self.max_limit))
+            self.stats["lowest_limit"] = self.stats["highest_limit"] = self.limit
+            self.condition.notify_all()
+
+    def acquire(self):
+        """Blocks until a call slot is free and returns the call's start time."""
+        with self.condition:
+            if self.in_flight >= int(self.limit):
+                self.stats["waits"] += 1
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+            self.stats["peak_in_flight"] = max(self.stats["peak_in_flight"], self.in_flight)
+        return time.monotonic()
+
+    def has_free_slot(self):
+        """Returns True if a call could start now without waiting for a slot."""
+        with self.condition:
+            return self.in_flight < int(self.limit)
+
+    def _latency_spike(self, operation, latency_seconds):
+        """Updates the operation's latency baseline and returns True if this call was a spike."""
+        baseline, samples = self.latency_baselines.get(operation, (latency_seconds, 0))
+        spike = samples >= CONCURRENCY_MIN_LATENCY_SAMPLES and latency_seconds > CONCURRENCY_LATENCY_SPIKE_FACTOR * max(baseline, 0.05)
+        if not spike:
+            # Spikes are kept out of the baseline so a slow period does not raise the bar
+            self.latency_baselines[operation] = (baseline + 0.2 * (latency_seconds - baseline), samples + 1)
+        return spike
+
+    def release(self, operation, started_at, overloaded, succeeded):
+        """Frees the call slot and adapts the limit to how the call went.
+
+        Every healthy call raises the limit by CONCURRENCY_ADDITIVE_INCREASE / limit, whether or not the
+        limit was reached, so a limit cut during an overload recovers while videos are processed one at a time.
+        """
+        latency_seconds = time.monotonic() - started_at
+        with self.condition:
+            self.in_flight -= 1
+            spike = succeeded and operation is not None and self._latency_spike(operation, latency_seconds)
+            if (overloaded or spike) and started_at >= self.last_decrease_at:
+                self.limit = max(self.min_limit, self.limit * CONCURRENCY_DECREASE_FACTOR)
+                self.last_decrease_at = time.monotonic()
+                self.stats["decreases"] += 1
+                reason = "a latency spike" if spike else "an overload response"
+                print(f"{self.name.capitalize()} concurrency limit cut to {int(self.limit)} after {reason} ({operation or 'transfer'}, {latency_seconds:.1f}s).")
+            elif succeeded and self.limit < self.max_limit:
+                self.limit = min(self.max_limit, self.limit + CONCURRENCY_ADDITIVE_INCREASE / self.limit)
+                self.stats["increases"] += 1
+            self.stats["lowest_limit"] = min(self.stats["lowest_limit"], self.limit)
+            self.stats["highest_limit"] = max(self.stats["highest_limit"], self.limit)
+            self.condition.notify_all()
+
+def is_overload_signal(outcome):
+    """Returns True if a call result or exception is a 429 or 5xx response."""
+    if rate_limit_retry_after(outcome) is not None:
+        return True
+    if isinstance(outcome, (dropbox.exceptions.InternalServerError, google_exceptions.ServerError)):
+        return True
+    response = outcome if isinstance(outcome, requests.Response) else getattr(outcome, 'response', None) if isinstance(outcome, requests.HTTPError) else None
+    return response is not None and response.status_code >= 500
+
+def remote_operation_name(func, args, kwargs):
+    """Names a remote call. Returns (name, latency_tracked).
+
+    Dropbox content transfers and generate_content vary in latency with the size of the video,
+    so they are not tracked for latency spikes (only their overload responses count).
+    """
+    route = args[0] if args else None
+    route_attrs = getattr(route, 'attrs', None)
+    if isinstance(route_attrs, dict):
+        # A Dropbox API route
+        return route.name, route_attrs.get('host') != 'content'
+    if func is requests.post:
+        # Resumable upload commands: start, query, or a fixed-size chunk
+        return f"upload ({kwargs.get('headers', {}).get('X-Goog-Upload-Command', 'start')})", True
+    name = getattr(func, '__name__', 'call')
+    return name, name not in ('generate_content', 'download_file')
+
+def load_concurrency_limits():
+    """Starts each API from the concurrency limit learned in earlier runs, read from the state store."""
+    learned = state_store.get_setting(CONCURRENCY_LIMITS_SETTING) or {}
+    for name, controller in concurrency_limits.items():
+        if name in learned:
+            controller.reset_limit(learned[name])
+
+def save_concurrency_limits():
+    """Records the current concurrency limits for the next run in the state store."""
+    state_store.put_setting(CONCURRENCY_LIMITS_SETTING, {name: controller.limit for name, controller in concurrency_limits.items()})
+
+# --- Retry Policy ---
+# Remote failures are transient (429, 5xx, connection errors and timeouts) or permanent
+# (everything else, e.g. a missing path or a rejected request). Transient ones are retried with
+# full-jitter exponential backoff, or after the server's Retry-After, until the attempts or the
+# per-call deadline run out. Retries are counted on the job of the video being processed.
+
+# The video whose processing a remote call belongs to (copied into hedge request threads)
+current_video = contextvars.ContextVar('current_video', default=None)
+# Set while a call_remote attempt runs several Dropbox SDK requests itself (they are not wrapped again)
+in_dropbox_transfer = contextvars.ContextVar('in_dropbox_transfer', default=False)
+
+@contextlib.contextmanager
+def remote_calls_for(file_entry):
+    """Attributes the remote-call retries made inside the block to the video's job."""
+    video_context = current_video.set(file_entry)
+    try:
+        yield
+    finally:
+        current_video.reset(video_context)
+
+def is_transient_error(outcome):
+    """Returns True if a call result or exception is worth retrying."""
+    if is_overload_signal(outcome):
+        return True
+    return isinstance(outcome, (
+        requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError, ConnectionError, TimeoutError,
+        google_exceptions.DeadlineExceeded, google_exceptions.ServiceUnavailable,
+    ))
+
+def describe_remote_outcome(outcome):
+    if isinstance(outcome, requests.Response):
+        return f"HTTP {outcome.status_code}"
+    return f"{type(outcome).__name__}: {outcome}"
+
+def retry_delay_seconds(attempt, retry_after):
+    """Backoff before the next attempt: Retry-After plus a little jitter, else full-jitter exponential."""
+    if retry_after is not None:
+        return retry_after + random.uniform(0, RETRY_BASE_DELAY_SECONDS)
+    return random.uniform(0, min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * 2 ** attempt))
+
+# --- Circuit Breakers ---
+# Each backend has a breaker that opens when one of its operations fails with a run of
+# consecutive transient errors (5xx, connection errors, timeouts; not 429s, which the rate
+# limiter handles). Failures are counted per operation, so a generation outage is caught even
+# while file uploads still succeed. While the breaker is open, calls to that backend fail fast
+# and queued videos are skipped before they are downloaded. After open_seconds a single
+# half-open probe is let through: success closes the breaker, failure opens it again.
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a backend whose circuit breaker is open."""
+
+    def __init__(self, api):
+        super().__init__(f"{api} circuit breaker is open")
+        self.api = api
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker for one backend, with a single half-open probe."""
+
+    def __init__(self, name, failure_threshold, open_seconds):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.state = CIRCUIT_CLOSED
+        self.opened_at = 0.0
+        self.consecutive_failures = {} # Operation -> count
+        self.lock = threading.Lock()
+        self.stats = {"opened": 0, "rejected_calls": 0, "probes": 0}
+
+    def restore(self, saved):
+        """Takes over the state saved by the previous run (see saved_state)."""
+        with self.lock:
+            # A probe that was in flight when the last run ended counts as open again
+            self.state = CIRCUIT_OPEN if saved.get("state") in (CIRCUIT_OPEN, CIRCUIT_HALF_OPEN) else CIRCUIT_CLOSED
+            self.opened_at = saved.get("opened_at", 0.0)
+            self.consecutive_failures = dict(saved.get("consecutive_failures", {}))
+
+    def saved_state(self):
+        with self.lock:
+            return {"state": self.state, "opened_at": self.opened_at, "consecutive_failures": dict(self.consecutive_failures)}
+
+    def probe_due(self):
+        return self.state == CIRCUIT_OPEN and time.time() >= self.opened_at + self.open_seconds
+
+    def before_call(self):
+        """Raises CircuitOpenError unless the call may go ahead (possibly as the half-open probe)."""
+        with self.lock:
+            if self.state == CIRCUIT_CLOSED:
+                return
+            if self.probe_due():
+                self.state = CIRCUIT_HALF_OPEN
+                self.stats["probes"] += 1
+                return
+            self.stats["rejected_calls"] += 1
+        raise CircuitOpenError(self.name)
+
+    def record(self, operation, healthy):
+        """Records whether the backend answered a call (any non-transient outcome counts as healthy)."""
+        with self.lock:
+            if healthy:
+                if self.state != CIRCUIT_CLOSED:
+                    # The probe succeeded
+                    print(f"{self.name.capitalize()} circuit breaker closed: the backend answered again.")
+                    self.state = CIRCUIT_CLOSED
+                    self.consecutive_failures.clear()
+                self.consecutive_failures.pop(operation, None)
+                return
+            failures = self.consecutive_failures[operation] = self.consecutive_failures.get(operation, 0) + 1
+            if self.state == CIRCUIT_HALF_OPEN or (self.state == CIRCUIT_CLOSED and failures >= self.failure_threshold):
+                self.state = CIRCUIT_OPEN
+                self.opened_at = time.time()
+                self.stats["opened"] += 1
+                print(f"{self.name.capitalize()} circuit breaker opened after {failures} consecutive failure(s) of {operation}."
+                      f" Calls fail fast for {self.open_seconds}s before a probe.")
+
+def probe_backend(api):
+    """Sends one cheap request to a backend (the half-open probe)."""
+    if api == REMOTE_API_GEMINI:
+        # A one-token generation checks the service every video depends on
+        generate_content(genai.GenerativeModel(GEMINI_MODEL_NAME), ["ping"], GenerationConfig(max_output_tokens=1))
+    else:
+        dbx.users_get_current_account() # Routed through call_remote by RateLimitedDropbox
+
+def unavailable_backends():
+    """Returns the backends whose circuit is open, first probing those that are due for a half-open request."""
+    unavailable = []
+    for api, breaker in sorted(circuit_breakers.items()):
+        if breaker.probe_due():
+            print(f"Probing {api} after its circuit breaker was open for {breaker.open_seconds}s...")
+            try:
+                probe_backend(api)
+            except Exception as e:
+                print(f"Probe of {api} failed: {e}")
+        if breaker.state != CIRCUIT_CLOSED:
+            unavailable.append(api)
+    return unavailable
+
+def load_circuit_breakers():
+    """Restores the circuit breaker states saved by the previous run from the state store."""
+    saved = state_store.get_setting(CIRCUIT_BREAKERS_SETTING) or {}
+    for name, breaker in circuit_breakers.items():
+        if name in saved:
+            breaker.restore(saved[name])
+
+def save_circuit_breakers():
+    """Records the circuit breaker states for the next run in the state store."""
+    state_store.put_setting(CIRCUIT_BREAKERS_SETTING, {name: breaker.saved_state() for name, breaker in circuit_breakers.items()})
+
+# --- Remote Calls ---
+
+def call_remote(api, func, *args, tokens=0, idempotent=True, **kwargs):
+    """Calls func(*args, **kwargs) through the rate limiter, concurrency limit and retry policy of the given API.
+
+    tokens is the estimated Gemini token cost; it is settled against the usage reported in the
+    response. Transient failures are retried until RETRY_MAX_ATTEMPTS attempts or the
+    RETRY_DEADLINE_SECONDS deadline are used up; then the error is raised (or the 429/5xx
+    response returned). Calls that are not idempotent are only retried after a 429, which
+    means the request was not processed. Raises CircuitOpenError while the API's circuit
+    breaker is open.
+    """
+    limiter = rate_limiters[api]
+    concurrency = concurrency_limits[api]
+    breaker = circuit_breakers[api]
+    operation, latency_tracked = remote_operation_name(func, args, kwargs)
+    deadline = time.monotonic() + RETRY_DEADLINE_SECONDS
+    attempt = 1
+    while True:
+        breaker.before_call()
+        limiter.acquire(tokens)
+        started_at = concurrency.acquire()
+        result = failure = None
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            failure = e
+        overloaded = is_overload_signal(failure if failure is not None else result)
+        concurrency.release(operation if latency_tracked else None, started_at, overloaded=overloaded, succeeded=failure is None and not overloaded)
+
+        outcome = failure if failure is not None else result if overloaded else None
+        retry_after = rate_limit_retry_after(outcome) if outcome is not None else None
+        # A 429 still shows the backend is up
+        breaker.record(operation, healthy=outcome is None or retry_after is not None or not is_transient_error(outcome))
+        if tokens:
+            # A failed or rejected request is not counted against the token quota
+            limiter.settle_tokens(tokens, gemini_used_tokens(result) if outcome is None else 0)
+        if outcome is None or not is_transient_error(outcome) or not (idempotent or retry_after is not None):
+            if failure is not None:
+                raise failure
+            return result
+
+        delay = retry_delay_seconds(attempt, retry_after)
+        if attempt >= RETRY_MAX_ATTEMPTS or time.monotonic() + delay > deadline:
+            limiter.stats["retries_exhausted"] += 1
+            print(f"Giving up on {api} {operation} after {attempt} attempt(s): {describe_remote_outcome(outcome)}")
+            if failure is not None:
+                raise failure
+            return result
+
+        limiter.stats["retries"] += 1
+        video_entry = current_video.get()
+        if video_entry is not None:
+            state_store.record_remote_retry(video_entry, f"{api} {operation}: {describe_remote_outcome(outcome)}")
+        if retry_after is not None:
+            print(f"{api.capitalize()} rate limit reached ({operation}). Waiting {delay:.0f}s (Retry-After) before attempt {attempt + 1}/{RETRY_MAX_ATTEMPTS}...")
+            limiter.pause(delay)
+        else:
+            print(f"Transient {api} error ({operation}): {describe_remote_outcome(outcome)}. Retrying in {delay:.1f}s (attempt {attempt + 1}/{RETRY_MAX_ATTEMPTS})...")
+            time.sleep(delay)
+        attempt += 1
+
+def generate_content(model, contents, generation_config):
+    """Calls model.generate_content through the Gemini rate limiter. Each attempt is cut off after RETRY_ATTEMPT_TIMEOUT_SECONDS."""
+    return call_remote(REMOTE_API_GEMINI, model.generate_content, contents, generation_config=generation_config,
+                       request_options={"timeout": RETRY_ATTEMPT_TIMEOUT_SECONDS}, tokens=estimate_gemini_tokens(contents))
+
+class RateLimitedDropbox(dropbox.Dropbox):
+    """Dropbox client whose every API route goes through call_remote.
+
+    The SDK's own retries are turned off so call_remote's limits and retry policy apply.
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("max_retries_on_rate_limit", 0)
+        kwargs.setdefault("max_retries_on_error", 0)
+        super().__init__(*args, **kwargs)
+
+    def request(self, route, namespace, request_arg, *args, **kwargs):
+        if in_dropbox_transfer.get():
+            # Already inside a call_remote attempt (see download_to_file)
+            return super().request(route, namespace, request_arg, *args, **kwargs)
+        return call_remote(REMOTE_API_DROPBOX, super().request, route, namespace, request_arg, *args,
+                           idempotent=is_idempotent_dropbox_request(route, request_arg), **kwargs)
+
+    def download_to_file(self, dropbox_path, local_path):
+        """Streams a file into local_path. Returns its metadata.
+
+        The request and the body read are one call_remote attempt, so a connection reset partway
+        through the body is retried, starting the file over.
+        """
+        def download_file():
+            transfer = in_dropbox_transfer.set(True)
+            try:
+                metadata, response = self.files_download(path=dropbox_path)
+                with response, open(local_path, 'wb') as f:
+                    for chunk in response.iter_content(DROPBOX_DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+                return metadata
+            finally:
+                in_dropbox_transfer.reset(transfer)
+        return call_remote(REMOTE_API_DROPBOX, download_file)
+
+def is_idempotent_dropbox_request(route, request_arg):
+    """Returns False for Dropbox writes that must not be repeated blindly.
+
+    These are upload session appends and uploads in add or update mode (run lock, leases, journal
+    segments). If the first attempt went through, a repeat fails on its offset or conflicts with it,
+    so they are only retried after a 429, which means nothing was written.
+    """
+    if route.name == 'upload_session/append':
+        return False
+    mode = getattr(request_arg, 'mode', None)
+    return not (route.name == 'upload' and mode is not None and (mode.is_add() or mode.is_update()))
+
+def print_rate_limit_summary():
+    """Prints how often each API was throttled, rate limited or retried, its adaptive concurrency limit and its circuit breaker."""
+    print("\nRate limiting:")
+    for name, limiter in sorted(rate_limiters.items()):
+        stats = limiter.stats
+        print(f"  - {name}: {stats['calls']} call(s), {stats['throttled_calls']} throttled for {stats['throttled_seconds']:.1f}s in total,"
+              f" {stats['rate_limited']} rate-limit response(s), {stats['retries']} retr{'y' if stats['retries'] == 1 else 'ies'},"
+              f" {stats['retries_exhausted']} call(s) out of retries")
+    print("Concurrency limits:")
+    for name, controller in sorted(concurrency_limits.items()):
+        stats = controller.stats
+        print(f"  - {name}: limit {int(controller.limit)} (range this run {int(stats['lowest_limit'])}-{int(stats['highest_limit'])}),"
+              f" peak {stats['peak_in_flight']} in flight, {stats['waits']} call(s) waited for a slot,"
+              f" {stats['increases']} increase(s), {stats['decreases']} decrease(s)")
+    if CIRCUIT_BREAKER_ENABLED:
+        print("Circuit breakers:")
+        for name, breaker in sorted(circuit_breakers.items()):
+            stats = breaker.stats
+            print(f"  - {name}: {breaker.state}, opened {stats['opened']} time(s), {stats['rejected_calls']} call(s) failed fast, {stats['probes']} probe(s)")
+
+# --- Hedged Generation Requests ---
+
+def hedge_delay_seconds():
+    """Returns the latency percentile after which a hedge request is fired, or None without enough history.
+
+    The history is the latency of each video's description request, kept on its job row in the
+    state store, so it travels with the state backend to every runner.
+    """
+    samples = state_store.recent_generation_latencies(GENERATION_LATENCY_HISTORY_SIZE)
+    if len(samples) < HEDGING_MIN_SAMPLES:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(len(ordered) * HEDGING_PERCENTILE / 100))
+    return ordered[index]
+
+def is_usable_generation_response(response):
+    """Returns True when a generate_content response has a candidate with content parts."""
+    try:
+        return bool(response.candidates and response.candidates[0].content.parts)
+    except Exception:
+        return False
+
+def generate_content_hedged(model, contents, generation_config, file_name):
+    """Calls generate_content, firing one identical hedge request if the call outlives the historical p95.
+
+    The first usable response wins. The losing request cannot be interrupted mid-flight, so it runs
+    on a daemon thread whose result is discarded. Hedges are capped per run by HEDGING_MAX_PER_RUN,
+    and none is fired while the Gemini concurrency limit has no free slot.
+    """
+    global hedges_fired_this_run, hedges_won_this_run
+
+    results = queue.Queue()
+
+    def run_request(label):
+        start_time = time.time()
+        try:
+            response = generate_content(model, contents, generation_config)
+            results.put((label, response, None, time.time() - start_time))
+        except Exception as e:
+            results.put((label, None, e, time.time() - start_time))
+
+    threading.Thread(target=contextvars.copy_context().run, args=(run_request, "primary"), daemon=True).start()
+    in_flight = 1
+
+    delay = hedge_delay_seconds() if HEDGING_ENABLED else None
+    first_wait = None if delay is None or hedges_fired_this_run >= HEDGING_MAX_PER_RUN else delay
+    last_error = None
+    while in_flight:
+        try:
+            label, response, error, latency = results.get(timeout=first_wait)
+        except queue.Empty:
+            first_wait = None
+            if not concurrency_limits[REMOTE_API_GEMINI].has_free_slot():
+                # A hedge would only queue behind the primary for its slot
+                print(f"Generation for {file_name} exceeded p{HEDGING_PERCENTILE} latency ({delay:.1f}s), but the Gemini concurrency limit is reached. Not hedging.")
+                continue
+            # Primary exceeded the p95 latency: fire a hedge and take whichever usable response arrives first
+            hedges_fired_this_run += 1
+            print(f"Generation for {file_name} exceeded p{HEDGING_PERCENTILE} latency ({delay:.1f}s). Firing hedge request ({hedges_fired_this_run}/{HEDGING_MAX_PER_RUN} this run)...")
+            threading.Thread(target=contextvars.copy_context().run, args=(run_request, "hedge"), daemon=True).start()
+            in_flight += 1
+            continue
+
+        in_flight -= 1
+        first_wait = None
+        if error is None and is_usable_generation_response(response):
+            if label == "hedge":
+                hedges_won_this_run += 1
+            video_entry = current_video.get()
+            if video_entry is not None:
+                state_store.record_generation_latency(video_entry, latency)
+            if in_flight:
+                print(f"Using {label} response for {file_name} after {latency:.1f}s. Discarding the other in-flight request.")
+            return response
+        last_error = error
+        if in_flight:
+            print(f"The {label} request for {file_name} returned {'an error' if error else 'no usable content'}. Waiting for the other request...")
+        elif error is None:
+            # Let the caller's normal blocked/empty handling see the response
+            return response
+
+    raise last_error
+
+# --- Input Path Latency ---
+
+def record_input_path_latency(input_path, latency_seconds):
+    """Records how long a video took from the start of processing to a generated description, per input path."""
+    input_path_latencies.setdefault(input_path, []).append(latency_seconds)
+
+def print_input_path_latency_summary():
+    """Prints per-input-path latency statistics for this run."""
+    if not input_path_latencies:
+        return
+    print("\nLatency to generated description by input path:")
+    for input_path, latencies in sorted(input_path_latencies.items()):
+        ordered = sorted(latencies)
+        print(f"  - {input_path}: {len(ordered)} video(s), mean {sum(ordered) / len(ordered):.1f}s, median {ordered[len(ordered) // 2]:.1f}s, max {ordered[-1]:.1f}s")
+
+# --- Resumable Gemini Uploads ---
+# Videos go to the Files API through the resumable upload protocol in fixed-size chunks. The session
+# URL and last acknowledged offset are kept on the video's job row (found by content hash) and
+# shipped with the state, so an interrupted upload (even on another runner, once the interrupted run
+# saved its state) continues from the last chunk the server confirmed instead of starting over.
+
+def start_resumable_upload(file_size, mime_type, display_name):
+    """Starts a resumable upload session and returns its upload URL."""
+    headers = {
+        "x-goog-api-key": GEMINI_API_KEY,
+        "X-Goog-Upload-Protocol": "resumable",
+        "X-Goog-Upload-Command": "start",
+        "X-Goog-Upload-Header-Content-Length": str(file_size),
+        "Content-Type": "application/json",
+    }
+    if mime_type:
+        headers["X-Goog-Upload-Header-Content-Type"] = mime_type
+    response = call_remote(REMOTE_API_GEMINI, requests.post, GEMINI_UPLOAD_ENDPOINT, headers=headers, json={"file": {"display_name": display_name}}, timeout=60)
+    response.raise_for_status()
+    upload_url = response.headers.get("X-Goog-Upload-URL")
+    if not upload_url:
+        raise RuntimeError("Gemini did not return an upload URL for the resumable session.")
+    return upload_url
+
+def query_resumable_upload(upload_url):
+    """Returns (status, bytes_received) for a resumable session, or (None, 0) if it no longer exists."""
+    response = call_remote(REMOTE_API_GEMINI, requests.post, upload_url, headers={"X-Goog-Upload-Command": "query"}, timeout=60)
+    if response.status_code in (404, 410):
+        return None, 0
+    response.raise_for_status()
+    return response.headers.get("X-Goog-Upload-Status"), int(response.headers.get("X-Goog-Upload-Size-Received", 0))
+
+def resumable_upload_to_gemini(file_entry, local_video_path, mime_type):
+    """Uploads a local video with the resumable protocol. Returns the Gemini file resource name."""
+    file_name = file_entry.name
+    file_size = os.path.getsize(local_video_path)
+    session = state_store.upload_session_for(file_entry)
+    offset = 0
+
+    if session and session.get("size") == file_size:
+        try:
+            status, offset = query_resumable_upload(session["upload_url"])
+        except requests.RequestException as e:
+            print(f"Warning: Could not query saved upload session for {file_name}: {e}. Starting a new session.")
+            status = None
+        if status == "active":
+            print(f"Resuming Gemini upload of {file_name} at byte {offset} of {file_size}.")
+        else:
+            session = None
+            offset = 0
+    else:
+        session = None
+
+    if session is None:
+        session = {"upload_url": start_resumable_upload(file_size, mime_type, file_name), "size": file_size, "offset": 0}
+        state_store.set_upload_session(file_entry, **session)
+
+    retries_left = RESUMABLE_UPLOAD_MAX_CHUNK_RETRIES
+    with mapped_file(local_video_path) as source:
+        while True:
+            chunk = source[offset:offset + RESUMABLE_UPLOAD_CHUNK_SIZE]
+            is_last_chunk = offset + len(chunk) >= file_size
+            headers = {
+                "X-Goog-Upload-Command": "upload, finalize" if is_last_chunk else "upload",
+                "X-Goog-Upload-Offset": str(offset),
+            }
+            try:
+                # A failed chunk is resumed from the offset the server confirms, not blindly re-sent
+                response = call_remote(REMOTE_API_GEMINI, requests.post, session["upload_url"], headers=headers, data=chunk,
+                                       timeout=RESUMABLE_UPLOAD_CHUNK_TIMEOUT_SECONDS, idempotent=False)
+                response.raise_for_status()
+            except requests.RequestException as e:
+                if retries_left <= 0:
+                    print(f"Gemini upload of {file_name} interrupted at byte {offset}. The session is saved and the next attempt will resume from there.")
+                    raise
+                retries_left -= 1
+                print(f"Warning: Chunk upload at byte {offset} failed for {file_name}: {e}. Querying session to resume ({retries_left} retries left)...")
+                status, offset = query_resumable_upload(session["upload_url"])
+                if status != "active":
+                    state_store.clear_upload_session(file_entry)
+                    raise RuntimeError(f"Resumable upload session for {file_name} is no longer active (status: {status}).")
+                continue
+
+            if is_last_chunk:
+                state_store.clear_upload_session(file_entry)
+                return response.json()["file"]["name"]
+
+            offset += len(chunk)
+            session["offset"] = offset
+            state_store.set_upload_session(file_entry, **session)
+            retries_left = RESUMABLE_UPLOAD_MAX_CHUNK_RETRIES
+            print(f"  ... Uploaded {offset} of {file_size} bytes ({offset * 100 // file_size}%)")
+
+# --- Scheduling ---
+# Videos are processed shortest-job-first: each one's processing time is estimated from its
+# duration (probed while it is processed, so known for retries and reprocessing) or size, scaled
+# by the median throughput of recently completed jobs. To keep large recordings from starving, every second a video has waited since
+# it was discovered lowers its score by SCHEDULER_AGING_WEIGHT seconds.
+
+def known_duration_seconds(file_entry):
+    """Returns the video duration recorded by an earlier attempt, or None for a video not processed before."""
+    job = state_store.get_job(file_entry)
+    return job["duration_seconds"] if job else None
+
+def ffprobe_duration_seconds(local_path):
+    """Returns the duration of a downloaded video from ffprobe, or None when ffprobe is missing or fails."""
+    if not shutil.which('ffprobe'):
+        return None
+    try:
+        result = subprocess.run(
+            ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1', local_path],
+            capture_output=True, text=True, timeout=60, check=True,
+        )
+        return float(result.stdout.strip())
+    except (subprocess.SubprocessError, OSError, ValueError) as e:
+        print(f"Warning: Could not probe the duration of {local_path} with ffprobe: {e}")
+        return None
+
+def gemini_file_duration_seconds(file_obj):
+    """Returns the duration Gemini reports in an ACTIVE video file's metadata, or None."""
+    video_duration = getattr(getattr(file_obj, 'video_metadata', None), 'video_duration', None)
+    return video_duration.total_seconds() if video_duration else None
+
+def historical_processing_rates():
+    """Returns (median processing seconds per video second, median processing seconds per byte) from recent jobs.
+
+    Either is None without enough history. The publish stage is left out, since it mostly measures
+    how long outputs waited for the batch commit.
+    """
+    per_media_second = []
+    per_byte = []
+    for job in state_store.completed_jobs(SCHEDULER_HISTORY_SIZE):
+        timings = json.loads(job["stage_timings"] or '{}')
+        processing_seconds = sum(seconds for stage, seconds in timings.items() if stage != STAGE_PUBLISHED)
+        if processing_seconds <= 0:
+            continue
+        if job["duration_seconds"]:
+            per_media_second.append(processing_seconds / job["duration_seconds"])
+        if job["size"]:
+            per_byte.append(processing_seconds / job["size"])
+    def median(values):
+        return sorted(values)[len(values) // 2] if len(values) >= SCHEDULER_MIN_HISTORY else None
+    return median(per_media_second), median(per_byte)
+
+def estimate_processing_seconds(file_entry, duration_seconds, rates):
+    """Estimates how long a video will take, preferring duration over size and history over defaults."""
+    seconds_per_media_second, seconds_per_byte = rates
+    if duration_seconds and seconds_per_media_second:
+        return duration_seconds * seconds_per_media_second
+    if seconds_per_byte:
+        return file_entry.size * seconds_per_byte
+    if duration_seconds:
+        return duration_seconds * DEFAULT_SECONDS_PER_MEDIA_SECOND
+    return file_entry.size * DEFAULT_SECONDS_PER_BYTE
+
+def schedule_videos(file_entries):
+    """Orders videos by estimated processing time minus an aging credit for the time they have waited.
+
+    The estimates are kept in video_cost_estimates for fair queuing across tenants.
+    """
+    if not file_entries:
+        return []
+    rates = historical_processing_rates()
+    now = time.time()
+    scored = []
+    for file_entry in file_entries:
+        duration_seconds = known_duration_seconds(file_entry)
+        job = state_store.get_job(file_entry)
+        waited_seconds = now - job["discovered_at"] if job else 0
+        estimate = estimate_processing_seconds(file_entry, duration_seconds, rates)
+        video_cost_estimates[file_entry.id] = estimate
+        scored.append((estimate - SCHEDULER_AGING_WEIGHT * waited_seconds, estimate, waited_seconds, file_entry))
+    if SCHEDULER_POLICY == SCHEDULER_POLICY_FIFO or len(scored) < 2:
+        return list(file_entries)
+    scored.sort(key=lambda item: item[0])
+    print("Processing order (shortest estimated job first, aged by waiting time):")
+    for score, estimate, waited_seconds, file_entry in scored:
+        print(f"  - {file_entry.name}: ~{estimate:.0f}s estimated, waiting {waited_seconds / 60:.0f} min")
+    return [file_entry for _, _, _, file_entry in scored]
+
+# --- Priority Lanes and Tenants ---
+# Videos are assigned to the first configured lane whose patterns match their path relative to the
+# watch folder (the last lane catches everything else), and likewise to a tenant (team). Processing
+# slots are shared between lanes with queued work in proportion to their share (stride scheduling),
+# so a bulk backfill keeps trickling along next to urgent work. A lane with "preempt_lower" also interrupts a video from a
+# lower lane at a stage boundary (before generation) when new work for it arrives; the interrupted
+# video goes back to the front of its lane and later resumes from its checkpoint.
+# Within a lane, tenants are served by weighted fair queuing on the videos' estimated processing
+# time, so one team's bulk upload cannot hold up the others; each tenant can also cap how many of
+# its videos hold a Gemini job at once (a preempted video keeps its slot).
+
+class VideoPreempted(Exception):
+    """Raised at a stage boundary when newly arrived urgent work should run first."""
+
+    def __init__(self, lane, urgent_lane):
+        super().__init__(f"preempted by {urgent_lane} work")
+        self.lane = lane
+        self.urgent_lane = urgent_lane
+
+def watch_relative_path(file_entry):
+    """Returns the video's path relative to the watch folder, e.g. 'Team A/standup.mp4'."""
+    return file_entry.path_display[len(DROPBOX_WATCH_FOLDER_PATH):].lstrip('/')
+
+def first_matching_rule(file_entry, rules):
+    """Returns the first rule (lane or tenant) whose patterns match the video's path relative to the watch folder, else the last rule."""
+    relative_path = watch_relative_path(file_entry).lower()
+    for rule in rules:
+        if any(fnmatch.fnmatch(relative_path, pattern.lower()) for pattern in rule.get("patterns", [])):
+            return rule
+    return rules[-1]
+
+def tenant_of(file_entry):
+    return first_matching_rule(file_entry, TENANTS)
+
+class LaneScheduler:
+    """Queues videos per priority lane and tenant, and picks the next one.
+
+    Lanes are chosen by their shares; within a lane, tenants are served by weighted fair queuing.
+    """
+
+    def __init__(self, lanes, tenants, file_entries):
+        self.lanes = lanes
+        self.tenants = tenants
+        self.queues = {lane["name"]: {tenant["name"]: [] for tenant in tenants} for lane in lanes}
+        self.passes = {lane["name"]: 0.0 for lane in lanes}
+        # Weighted fair queuing state per lane: virtual time and each tenant's last virtual finish tag
+        self.virtual_times = {lane["name"]: 0.0 for lane in lanes}
+        self.finish_tags = {lane["name"]: {tenant["name"]: 0.0 for tenant in tenants} for lane in lanes}
+        self.in_flight = {tenant["name"]: set() for tenant in tenants} # Video ids holding a Gemini job slot
+        self.known_ids = set()
+        self.started = []
+        self.preempted_ids = set()
+        self.tenant_stats = {tenant["name"]: {"started": 0, "published": 0, "waits": [], "processing_seconds": 0.0} for tenant in tenants}
+        self.start_times = {}
+        for file_entry in file_entries:
+            self.add(file_entry)
+
+    def lane_of(self, file_entry):
+        """Returns the lane dict for a video (first matching lane, else the last lane)."""
+        return first_matching_rule(file_entry, self.lanes)
+
+    def _lane_queued(self, lane_name):
+        return sum(len(queue) for queue in self.queues[lane_name].values())
+
+    def add(self, file_entry):
+        """Queues a video (once). Returns its lane name, or None if it was already known."""
+        if file_entry.id in self.known_ids:
+            return None
+        self.known_ids.add(file_entry.id)
+        lane_name = self.lane_of(file_entry)["name"]
+        if not self._lane_queued(lane_name):
+            # A lane that was idle starts level with the busy ones instead of with banked credit
+            busy_passes = [self.passes[name] for name in self.queues if self._lane_queued(name)]
+            self.passes[lane_name] = max(self.passes[lane_name], min(busy_passes, default=0.0))
+        self.queues[lane_name][tenant_of(file_entry)["name"]].append(file_entry)
+        return lane_name
+
+    def requeue(self, file_entry):
+        """Puts a preempted video back at the front of its lane (it keeps its Gemini job slot)."""
+        self.preempted_ids.add(file_entry.id)
+        self.queues[self.lane_of(file_entry)["name"]][tenant_of(file_entry)["name"]].insert(0, file_entry)
+
+    def _eligible_tenants(self, lane_name):
+        """Tenants with queued work in the lane that are under their cap on concurrent Gemini jobs."""
+        eligible = []
+        for tenant in self.tenants:
+            queue = self.queues[lane_name][tenant["name"]]
+            if not queue:
+                continue
+            cap = tenant.get("max_concurrent_gemini_jobs")
+            if cap is None or queue[0].id in self.in_flight[tenant["name"]] or len(self.in_flight[tenant["name"]]) < cap:
+                eligible.append(tenant)
+        return eligible
+
+    def next_video(self):
+        """Returns the next video to process, or None when nothing eligible is queued."""
+        candidates = [lane for lane in self.lanes if self._eligible_tenants(lane["name"])]
+        if not candidates:
+            return None
+        lane = min(candidates, key=lambda candidate: self.passes[candidate["name"]])
+        lane_name = lane["name"]
+        self.passes[lane_name] += 1.0 / max(lane.get("share", 1), 1e-9)
+
+        # Weighted fair queuing: serve the tenant whose head video would finish first in virtual time
+        def tags(tenant):
+            head = self.queues[lane_name][tenant["name"]][0]
+            start_tag = max(self.virtual_times[lane_name], self.finish_tags[lane_name][tenant["name"]])
+            return start_tag, start_tag + max(video_cost_estimates.get(head.id, 1.0), 1.0) / max(tenant.get("weight", 1), 1e-9)
+        tenant = min(self._eligible_tenants(lane_name), key=lambda candidate: tags(candidate)[::-1])
+        start_tag, finish_tag = tags(tenant)
+        self.virtual_times[lane_name] = start_tag
+        self.finish_tags[lane_name][tenant["name"]] = finish_tag
+
+        file_entry = self.queues[lane_name][tenant["name"]].pop(0)
+        self.in_flight[tenant["name"]].add(file_entry.id)
+        self.start_times[file_entry.id] = time.time()
+        if file_entry.id not in self.preempted_ids:
+            self.started.append(file_entry)
+            stats = self.tenant_stats[tenant["name"]]
+            stats["started"] += 1
+            job = state_store.get_job(file_entry)
+            if job:
+                stats["waits"].append(time.time() - job["discovered_at"])
+        return file_entry
+
+    def finish(self, file_entry):
+        """Frees the video's Gemini job slot once it is done with (unless it was preempted and requeued)."""
+        tenant_name = tenant_of(file_entry)["name"]
+        self.tenant_stats[tenant_name]["processing_seconds"] += time.time() - self.start_times.pop(file_entry.id, time.time())
+        self.in_flight[tenant_name].discard(file_entry.id)
+
+    def record_published(self, file_entry):
+        self.tenant_stats[tenant_of(file_entry)["name"]]["published"] += 1
+
+    def started_videos(self):
+        return list(self.started)
+
+    def queue_lengths(self):
+        return {name: self._lane_queued(name) for name in self.queues}
+
+    def urgent_lane_waiting(self, file_entry):
+        """Returns the name of a higher, preempting lane with eligible queued work, or None.
+
+        A video is preempted at most once per run, so lower lanes still finish under steady urgent load.
+        """
+        if file_entry.id in self.preempted_ids:
+            return None
+        lane_index = self.lanes.index(self.lane_of(file_entry))
+        for lane in self.lanes[:lane_index]:
+            if lane.get("preempt_lower") and self._eligible_tenants(lane["name"]):
+                return lane["name"]
+        return None
+
+    def print_tenant_metrics(self):
+        """Prints per-tenant throughput and queue wait for this run."""
+        print("\nPer-tenant metrics for this run:")
+        for tenant in self.tenants:
+            stats = self.tenant_stats[tenant["name"]]
+            waits = sorted(stats["waits"])
+            median_wait = f"{waits[len(waits) // 2] / 60:.1f} min" if waits else "n/a"
+            throughput = f"{stats['published'] / (stats['processing_seconds'] / 3600):.1f} videos/hour" if stats["processing_seconds"] > 0 else "n/a"
+            queued = sum(len(self.queues[lane_name][tenant["name"]]) for lane_name in self.queues)
+            print(f"  - {tenant['name']} (weight {tenant.get('weight', 1)}): {stats['started']} started, {stats['published']} published,"
+                  f" {queued} still queued, median queue wait {median_wait}, throughput {throughput}")
+
+def check_for_preemption(file_entry):
+    """At a stage boundary: picks up newly arrived videos and raises VideoPreempted if a higher lane wants the slot."""
+    global last_urgent_poll_time
+    if not PRIORITY_LANES_ENABLED or lane_scheduler is None:
+        return
+    if time.time() - last_urgent_poll_time >= PRIORITY_LANES_POLL_SECONDS:
+        last_urgent_poll_time = time.time()
+        try:
+            entries = list_dropbox_folder(dbx, DROPBOX_WATCH_FOLDER_PATH, recursive=True)
+        except Exception as e:
+            print(f"Warning: Could not poll the watch folder for new work: {e}")
+            entries = []
+        entries = [entry for entry in entries if isinstance(entry, dropbox.files.FileMetadata) and entry.id not in lane_scheduler.known_ids and in_this_shard(entry)]
+        new_videos = find_videos_to_process(entries, published_outputs, datetime.utcnow() - timedelta(days=1), quiet=True)
+        for new_video in schedule_videos(new_videos):
+            print(f"Queued newly arrived {new_video.name} in the {lane_scheduler.add(new_video)} lane.")
+    urgent_lane = lane_scheduler.urgent_lane_waiting(file_entry)
+    if urgent_lane:
+        raise VideoPreempted(lane_scheduler.lane_of(file_entry)["name"], urgent_lane)
+
+# --- Video Processing Stages ---
+
+def guess_video_mime_type(file_name):
+    """Guesses a video MIME type from the file extension. Returns None when not confident."""
+    guessed_mime_type, _ = mimetypes.guess_type(file_name)
+    if guessed_mime_type and 'video/' in guessed_mime_type:
+        print(f"Guessed MIME type from extension: {guessed_mime_type}")
+        return guessed_mime_type
+    print(f"Warning: Could not determine confident video MIME type for {file_name} from extension. Proceeding without explicit MIME type (Gemini might reject).")
+    return None
+
+def delete_gemini_file(file_obj, reason):
+    """Deletes a Gemini file, logging (not raising) any error."""
+    if file_obj and hasattr(file_obj, 'name'):
+        state_store.clear_gemini_file_name(file_obj.name)
+        try:
+            call_remote(REMOTE_API_GEMINI, genai.delete_file, file_obj.name)
+            print(f"Deleted Gemini file {file_obj.name} after {reason}.")
+        except Exception as delete_e:
+            print(f"Error deleting Gemini file {file_obj.name} after {reason}: {delete_e}")
+
+def upload_video_to_gemini(file_entry, local_video_path):
+    """Uploads a local video to the Gemini Files API (resumable, chunked).
+
+    Returns the uploaded file object, which may still be PROCESSING. Raises on upload failure
+    (an interrupted upload session is kept for the next attempt).
+    """
+    print("Uploading video to Gemini API...")
+    gemini_file_name = resumable_upload_to_gemini(file_entry, local_video_path, guess_video_mime_type(file_entry.name))
+    file_obj = call_remote(REMOTE_API_GEMINI, genai.get_file, gemini_file_name)
+    print(f"Uploaded file to Gemini: {file_obj.uri}, State: {file_obj.state}")
+    return file_obj
+
+def wait_for_gemini_file(file_obj, file_name):
+    """Waits until an uploaded Gemini file is ACTIVE and returns it.
+
+    Raises on timeout, FAILED or CANCELLED state (the Gemini file is deleted before raising).
+    """
+    print("Waiting for Gemini processing...")
+    processing_start_time = time.time()
+
+    # Use raw integer state values for robustness
+    succeeded_state_value = 2
+    failed_state_value = 3
+    cancelled_state_value = 4
+    terminal_state_values_numeric = [succeeded_state_value, failed_state_value, cancelled_state_value]
+
+    try:
+        while file_obj.state not in terminal_state_values_numeric:
+            if not file_obj or not hasattr(file_obj, 'name'):
+                print("Error: Gemini file_obj is invalid during wait loop.")
+                raise RuntimeError("Gemini file object invalid during wait loop.")
+
+            if time.time() - processing_start_time > PROCESSING_TIMEOUT_SECONDS:
+                print(f"Gemini processing timed out after {PROCESSING_TIMEOUT_SECONDS} seconds for {file_name}. Current state: {file_obj.state}")
+                raise TimeoutError(f"Gemini processing timed out for {file_name}. Current state: {file_obj.state}")
+
+            time.sleep(15)
+
+            try:
+                file_obj = call_remote(REMOTE_API_GEMINI, genai.get_file, file_obj.name)
+            except CircuitOpenError:
+                raise
+            except Exception as get_file_e:
+                print(f"Warning: Error getting Gemini file status for {file_obj.name}: {get_file_e}. Retrying status check...")
+                continue
+
+            print(f"  ... State: {file_obj.state}, Elapsed: {int(time.time() - processing_start_time)}s")
+
+        if file_obj.state == failed_state_value:
+            error_message = file_obj.error.message if hasattr(file_obj, 'error') and file_obj.error else 'N/A'
+            print(f"Gemini processing failed for {file_name}. State: {file_obj.state}, Error: {error_message}")
+            raise RuntimeError(f"Gemini processing failed: {file_obj.state} - {error_message}")
+        elif file_obj.state == cancelled_state_value:
+            print(f"Gemini processing was cancelled for {file_name}. State: {file_obj.state}")
+            raise RuntimeError(f"Gemini processing was cancelled: {file_obj.state}")
+    except Exception:
+        delete_gemini_file(file_obj, "Gemini processing/wait error")
+        raise
+
+    print(f"Gemini processing succeeded for {file_name}.")
+    return file_obj
+
+def generate_description(model, source_parts, file_name, text_only=False):
+    """Generates a structured description from the given source parts (video file or transcript text).
+
+    Returns (response_text, description_data, content_blocked). response_text is None when
+    nothing publishable was generated.
+    """
+    prompt = final_prompt_string
+    if text_only:
+        prompt = TRANSCRIPT_SOURCE_PROMPT_PREFIX + prompt
+    response = generate_content_hedged(
+        model,
+        [prompt] + source_parts,
+        GEMINI_GENERATION_CONFIG,
+        file_name
+    )
+
+    response_text, content_blocked, finish_reason_str = extract_candidate_text(response)
+    response_truncated = 'MAX_TOKENS' in finish_reason_str
+    description_data = None # Parsed JSON description (JSON output format only)
+
+    if response_text and OUTPUT_FORMAT == OUTPUT_FORMAT_JSON:
+        # Schema-constrained output: validate locally and render deterministically
+        description_data = parse_description_json(response_text)
+        if description_data is None:
+            print(f"Warning: Could not parse schema JSON from Gemini response for {file_name}.")
+            response_text = None # Parse failure, nothing to render
+        else:
+            response_text = render_description_markdown(description_data)
+    # Check for minimal text length - if text is super short, maybe it's also a form of filtering or failed generation
+    elif response_text and len(response_text.strip()) < 50: # Require at least 50 characters for valid content
+        print(f"Warning: Generated text is very short ({len(response_text.strip())} chars), possibly incomplete or minimal output.")
+        # Treat minimal text as blocked for saving/uploading purposes, but don't raise error
+        content_blocked = True # Treat as blocked so it doesn't save the empty/minimal markdown
+        response_text = None # Clear the text so it goes to the 'else' block
+
+    # --- Validate sections against the example and repair only what is missing ---
+    if response_text and not content_blocked:
+        response_text, description_data = repair_missing_sections(
+            model, source_parts, file_name, response_text, description_data, response_truncated
+        )
+
+    return response_text, description_data, content_blocked
+
+def output_base_path(file_entry):
+    """Returns where a video's outputs go, relative to the output folder and without extension.
+
+    Subfolders of the watch folder are mirrored, so same-named videos in different subfolders
+    get their own descriptions.
+    """
+    return os.path.splitext(watch_relative_path(file_entry))[0]
+
+def publish_description(publish_batch, file_entry, response_text, description_data, stamp):
+    """Saves the stamped markdown and HTML outputs locally and stages both in the Dropbox publish batch.
+
+    Returns True only when both files were staged. They are published once the batch commits.
+    """
+    file_name = file_entry.name
+    base_path = output_base_path(file_entry)
+    output_md_local_path = os.path.join(LOCAL_OUTPUT_DIR, f"{base_path}.md")
+    output_html_local_path = os.path.join(LOCAL_OUTPUT_DIR, f"{base_path}.html")
+    os.makedirs(os.path.dirname(output_md_local_path), exist_ok=True)
+    property_groups = stamp_property_groups(stamp)
+
+    with open(output_md_local_path, "w", encoding='utf-8') as f:
+        f.write(embed_output_stamp(response_text, stamp))
+    print(f"Saved markdown locally: {output_md_local_path}")
+
+    # Ensure markdown conversion doesn't fail on unexpected short strings
+    html_converted = True # Assume success unless conversion fails
+    try:
+        if description_data is not None:
+            html_content = render_description_html(description_data)
+        else:
+            html_content = markdown.markdown(response_text)
+        with open(output_html_local_path, "w", encoding='utf-8') as f:
+            f.write(embed_output_stamp(html_content, stamp, html_output=True))
+        print(f"Saved HTML locally: {output_html_local_path}")
+    except Exception as md_convert_e:
+        print(f"Error converting markdown to HTML for {file_name}: {md_convert_e}")
+        html_converted = False
+
+    dropbox_md_target_path = os.path.join(DROPBOX_OUTPUT_FOLDER_PATH, f"{base_path}.md")
+    dropbox_html_target_path = os.path.join(DROPBOX_OUTPUT_FOLDER_PATH, f"{base_path}.html")
+    outputs = [(output_md_local_path, dropbox_md_target_path, property_groups)]
+    # Only stage the HTML output if conversion was successful
+    if html_converted:
+        outputs.append((output_html_local_path, dropbox_html_target_path, property_groups))
+    else:
+        print(f"Staging Markdown only for {file_name} (HTML conversion failed). NOT marking as fully processed in this run.")
+
+    print("Staging results for the Dropbox batch commit...")
+    return publish_batch.stage_outputs(file_entry.path_display, outputs, complete=html_converted) and html_converted
+
+# --- Transcript Cache ---
+
+def transcript_cache_paths(content_hash):
+    """Returns the local (transcript, visual notes) cache paths for a video content hash."""
+    return (
+        os.path.join(TRANSCRIPT_CACHE_LOCAL_DIR, f"{content_hash}.transcript.md"),
+        os.path.join(TRANSCRIPT_CACHE_LOCAL_DIR, f"{content_hash}.visual_notes.md"),
+    )
+
+def load_cached_transcript(dbx_client, content_hash):
+    """Loads a cached (transcript, visual_notes) pair for a video content hash.
+
+    Checks the local cache directory first, then the Dropbox transcript folder (copying hits
+    into the local cache). Returns None on a cache miss.
+    """
+    local_paths = transcript_cache_paths(content_hash)
+    if all(os.path.exists(path) for path in local_paths):
+        cached = tuple(read_text_file(path) for path in local_paths)
+        if all(text is not None for text in cached):
+            return cached
+
+    cached = []
+    for local_path in local_paths:
+        dropbox_path = f"{DROPBOX_TRANSCRIPT_FOLDER_PATH}/{os.path.basename(local_path)}"
+        try:
+            _, res = dbx_client.files_download(path=dropbox_path)
+        except dropbox.exceptions.ApiError as e:
+            if e.error.is_path() and e.error.get_path().is_not_found():
+                return None
+            print(f"Warning: Error reading cached transcript {dropbox_path} from Dropbox: {e}")
+            return None
+        cached.append(res.content.decode('utf-8'))
+
+    os.makedirs(TRANSCRIPT_CACHE_LOCAL_DIR, exist_ok=True)
+    for local_path, text in zip(local_paths, cached):
+        with open(local_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+    print(f"Loaded cached transcript and visual notes for content hash {content_hash} from Dropbox.")
+    return tuple(cached)
+
+def extract_transcript(model, video_part, file_name):
+    """Runs the transcript pass against a video (Gemini file or inline part). Returns (transcript, visual_notes) or None."""
+    extracted = []
+    for label, prompt in (("transcript", TRANSCRIPT_EXTRACTION_PROMPT), ("visual notes", VISUAL_NOTES_EXTRACTION_PROMPT)):
+        print(f"Extracting {label} for {file_name}...")
+        response = generate_content(model, [prompt, video_part], TRANSCRIPT_GENERATION_CONFIG)
+        text, content_blocked, _ = extract_candidate_text(response)
+        if not text or content_blocked:
+            print(f"Warning: Gemini returned no usable {label} for {file_name}.")
+            return None
+        extracted.append(text.strip() + '\n')
+    return tuple(extracted)
+
+def store_transcript(dbx_client, content_hash, transcript, visual_notes):
+    """Writes a transcript and visual notes to the local cache and mirrors them to Dropbox."""
+    os.makedirs(TRANSCRIPT_CACHE_LOCAL_DIR, exist_ok=True)
+    for local_path, text in zip(transcript_cache_paths(content_hash), (transcript, visual_notes)):
+        with open(local_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        upload_file_to_dropbox(dbx_client, local_path, f"{DROPBOX_TRANSCRIPT_FOLDER_PATH}/{os.path.basename(local_path)}")
+
+def transcript_source_parts(transcript, visual_notes):
+    """Builds the text-only source parts used in place of the video."""
+    return [TRANSCRIPT_SOURCE_TEMPLATE.format(transcript=transcript, visual_notes=visual_notes)]
+
+def resume_gemini_file(file_entry, gemini_file_name, file_name):
+    """Picks up a Gemini file uploaded by an interrupted attempt, waiting for it if still PROCESSING.
+
+    Returns the ACTIVE file object, or None when it has to be uploaded again.
+    """
+    try:
+        file_obj = wait_for_gemini_file(call_remote(REMOTE_API_GEMINI, genai.get_file, gemini_file_name), file_name)
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        print(f"Could not resume Gemini file {gemini_file_name} for {file_name} ({e}). Uploading again.")
+        state_store.clear_gemini_file_name(gemini_file_name)
+        return None
+    print(f"Resumed Gemini file {file_obj.name} uploaded by an interrupted attempt.")
+    state_store.advance_stage(file_entry, STAGE_GEMINI_ACTIVE)
+    return file_obj
+
+def stage_description_outputs(publish_batch, file_entry, response_text, description_data):
+    """Renders a generated description and stages its outputs, checkpointing the rendered stage."""
+    if work_queue and not work_queue.holds(file_entry):
+        print(f"Not publishing {file_entry.name}: this worker no longer holds its lease.")
+        state_store.mark_failed(file_entry, "lease lost before publishing")
+        return False
+    if not publish_description(publish_batch, file_entry, response_text, description_data, build_output_stamp(file_entry)):
+        state_store.mark_failed(file_entry, "rendering or staging outputs failed")
+        return False
+    state_store.advance_stage(file_entry, STAGE_RENDERED)
+    return True
+
+def mark_video_published(file_entry):
+    """Commits the published stage for a video whose outputs were committed to Dropbox."""
+    base_path = output_base_path(file_entry)
+    state_store.advance_stage(
+        file_entry, STAGE_PUBLISHED,
+        output_md_hash=published_output_hashes.get(os.path.join(DROPBOX_OUTPUT_FOLDER_PATH, f"{base_path}.md").lower()),
+        output_html_hash=published_output_hashes.get(os.path.join(DROPBOX_OUTPUT_FOLDER_PATH, f"{base_path}.html").lower()),
+        # The published outputs are the record now; keeping the text would grow the state snapshot with the archive
+        generated_text=None,
+        description_data=None,
+    )
+    if work_queue:
+        work_queue.complete(file_entry)
+    print(f"Marked '{file_entry.path_display}' as processed.")
+
+def mark_unpublished_failed(file_entries, published_paths):
+    """Records a failed attempt for videos whose outputs were staged but not committed."""
+    for file_entry in file_entries:
+        if file_entry.path_display in published_paths:
+            continue
+        if work_queue:
+            work_queue.release(file_entry)
+        row = state_store.get_job(file_entry)
+        if row is not None and row["status"] == STATUS_RUNNING:
+            state_store.mark_failed(file_entry, "committing outputs to Dropbox failed")
+
+def process_video_entry(dbx_client, publish_batch, file_entry):
+    """Runs one watch-folder video through download, Gemini, generation and publishing.
+
+    Returns True when both outputs were staged in publish_batch. The video can be marked as
+    processed once the batch reports its path as published.
+    """
+    dropbox_watch_file_path = file_entry.path_display
+    file_name = file_entry.name
+    content_hash = getattr(file_entry, 'content_hash', None)
+    local_temp_video_path = os.path.join(LOCAL_OUTPUT_DIR, f"temp_video_{file_entry.id.replace('id:', '')}_{file_name}")
+    model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+
+    print(f"\n--- Processing {file_name} ---")
+    job = state_store.get_job(file_entry)
+    # A finished job (e.g. one being reprocessed) starts over; an interrupted one continues after its last checkpoint
+    resume_stage = job["stage"] if job and job["status"] != STATUS_DONE else STAGE_DISCOVERED
+    if resume_stage != STAGE_DISCOVERED:
+        print(f"Resuming {file_name} after its last completed stage '{resume_stage}'.")
+    state_store.start_attempt(file_entry)
+
+    # --- Transcript tier: text-only generation when this video was already transcribed ---
+    processing_start_time = time.time()
+    source_parts = None
+    text_only = False
+    input_path = INPUT_PATH_TRANSCRIPT
+    if TRANSCRIPT_CACHE_ENABLED and content_hash:
+        cached = load_cached_transcript(dbx_client, content_hash)
+        if cached:
+            print(f"Using cached transcript for {file_name}. Skipping video download and Gemini upload.")
+            source_parts = transcript_source_parts(*cached)
+            text_only = True
+
+    file_obj = None
+    video_part = None
+    try:
+        if resume_stage in (STAGE_GENERATED, STAGE_RENDERED):
+            if job["generated_text"] and job["prompt_version"] == PROMPT_VERSION:
+                # The description survived the interruption; only rendering and publishing are left
+                print(f"Using the description generated before the interruption for {file_name}.")
+                description_data = json.loads(job["description_data"]) if job["description_data"] else None
+                return stage_description_outputs(publish_batch, file_entry, job["generated_text"], description_data)
+            print(f"Checkpointed description for {file_name} is missing or from another prompt version. Regenerating.")
+
+        if source_parts is None and resume_stage in (STAGE_GEMINI_UPLOADED, STAGE_GEMINI_ACTIVE) and job["gemini_file_name"]:
+            file_obj = resume_gemini_file(file_entry, job["gemini_file_name"], file_name)
+            if file_obj is not None:
+                input_path = INPUT_PATH_FILES_API
+                video_part = file_obj
+        if source_parts is None and video_part is None:
+            file_obj = find_cached_gemini_file(content_hash)
+            if file_obj is not None:
+                input_path = INPUT_PATH_FILES_API
+                video_part = file_obj
+        if source_parts is None and video_part is None:
+            if os.path.exists(local_temp_video_path) and os.path.getsize(local_temp_video_path) == file_entry.size:
+                # A previous attempt on this runner was interrupted after the download finished
+                print(f"Reusing previously downloaded {local_temp_video_path}.")
+            elif not download_file_from_dropbox(dbx_client, dropbox_watch_file_path, local_temp_video_path):
+                print(f"Skipping processing for {file_name} due to download failure from Dropbox.")
+                # Don't mark as processed so it can be retried
+                state_store.mark_failed(file_entry, "download from Dropbox failed")
+                return False
+            state_store.advance_stage(file_entry, STAGE_DOWNLOADED)
+            state_store.record_duration(file_entry, ffprobe_duration_seconds(local_temp_video_path))
+
+            mime_type = guess_video_mime_type(file_name) if INLINE_VIDEO_ENABLED else None
+            if mime_type and os.path.getsize(local_temp_video_path) <= INLINE_VIDEO_MAX_BYTES:
+                # Fast path: small videos go inline in the request, with no Files API upload, polling or cleanup
+                print(f"Video is {os.path.getsize(local_temp_video_path)} bytes (<= {INLINE_VIDEO_MAX_BYTES}). Sending inline instead of via the Files API.")
+                with open(local_temp_video_path, 'rb') as f:
+                    video_part = {"mime_type": mime_type, "data": f.read()}
+                input_path = INPUT_PATH_INLINE
+            else:
+                try:
+                    file_obj = upload_video_to_gemini(file_entry, local_temp_video_path)
+                    state_store.advance_stage(file_entry, STAGE_GEMINI_UPLOADED, gemini_file_name=file_obj.name)
+                    # Stage boundary: the uploaded file is picked up again when the video resumes
+                    check_for_preemption(file_entry)
+                    file_obj = wait_for_gemini_file(file_obj, file_name)
+                except (CircuitOpenError, VideoPreempted):
+                    raise
+                except Exception as gemini_process_e:
+                    # This catches errors during Gemini upload or the waiting loop
+                    print(f"Error during Gemini upload or waiting for processing for {file_name}: {gemini_process_e}")
+                    state_store.mark_failed(file_entry, f"Gemini upload failed: {gemini_process_e}")
+                    return False
+                state_store.advance_stage(file_entry, STAGE_GEMINI_ACTIVE)
+                video_part = file_obj
+                input_path = INPUT_PATH_FILES_API
+
+        if file_obj is not None:
+            # Gemini's own reading of the duration, also for a resumed or reused file that was not downloaded
+            state_store.record_duration(file_entry, gemini_file_duration_seconds(file_obj))
+            # Stage boundary: the ACTIVE file is reused when the video resumes
+            check_for_preemption(file_entry)
+
+        if source_parts is None:
+            source_parts = [video_part]
+            if TRANSCRIPT_CACHE_ENABLED and content_hash:
+                try:
+                    extracted = extract_transcript(model, video_part, file_name)
+                except CircuitOpenError:
+                    raise
+                except Exception as transcript_e:
+                    print(f"Error extracting transcript for {file_name}: {transcript_e}. Falling back to video input.")
+                    extracted = None
+                if extracted:
+                    store_transcript(dbx_client, content_hash, *extracted)
+                    source_parts = transcript_source_parts(*extracted)
+                    text_only = True
+
+        # Stage boundary: urgent work that arrived meanwhile runs before this video's generation
+        check_for_preemption(file_entry)
+
+        # --- Generate content with Gemini ---
+        if text_only:
+            print("Generating content with Gemini using template, example, and cached transcript...")
+        else:
+            print("Generating content with Gemini using template, example, and video...")
+        try:
+            response_text, description_data, content_blocked = generate_description(model, source_parts, file_name, text_only)
+            record_input_path_latency(input_path, time.time() - processing_start_time)
+        except CircuitOpenError:
+            # Not the video's fault: its checkpoint and Gemini file are kept for a later run
+            raise
+        except Exception as content_gen_e:
+            print(f"Error during Gemini content generation process for {file_name}: {content_gen_e}")
+            # Don't mark as processed
+            state_store.mark_failed(file_entry, f"generation failed: {content_gen_e}")
+            delete_gemini_file(file_obj, "generation error")
+            return False
+
+        # Decision point: Save/Upload only if content was not blocked AND valid text was extracted
+        if response_text and not content_blocked:
+            state_store.advance_stage(
+                file_entry, STAGE_GENERATED,
+                generated_text=response_text,
+                description_data=json.dumps(description_data) if description_data is not None else None,
+                prompt_version=PROMPT_VERSION,
+            )
+            checkpoint_state("generation")
+            return stage_description_outputs(publish_batch, file_entry, response_text, description_data)
+
+        if content_blocked:
+            print(f"Skipping saving/uploading for {file_name} due to content blocking or minimal output.")
+            # Decide if you want to treat a blocked response as 'processed' or retry
+        else: # This covers cases where response_text is None for other reasons (e.g. extraction error)
+            print(f"Gemini generated empty or invalid text content for {file_name} (not explicitly blocked). No output files generated.")
+        state_store.mark_failed(file_entry, "content blocked" if content_blocked else "empty response")
+        delete_gemini_file(file_obj, "empty/blocked response")
+        return False
+
+    finally:
+        # --- Cleanup ---
+        # Clean up the local temporary video file
+        if os.path.exists(local_temp_video_path):
+            try: os.remove(local_temp_video_path)
+            except OSError as e: print(f"Error removing temporary local file {local_temp_video_path}: {e}")
+
+        # Clean up local output files after attempted upload - Check if they exist before trying to remove
+        base_path = output_base_path(file_entry)
+        output_md_local_path_potential = os.path.join(LOCAL_OUTPUT_DIR, f"{base_path}.md")
+        output_html_local_path_potential = os.path.join(LOCAL_OUTPUT_DIR, f"{base_path}.html")
+        if os.path.exists(output_md_local_path_potential):
+            try: os.remove(output_md_local_path_potential)
+            except OSError as e: print(f"Error removing local file {output_md_local_path_potential}: {e}")
+        if os.path.exists(output_html_local_path_potential):
+            try: os.remove(output_html_local_path_potential)
+            except OSError as e: print(f"Error removing local file {output_html_local_path_potential}: {e}")
+        print("Cleaned up local temporary files.")
+
+def dropbox_content_hash(local_path):
+    """Computes the Dropbox content_hash of a local file (SHA-256 over the SHA-256s of each 4 MiB block)."""
+    block_hashes = hashlib.sha256()
+    with mapped_file(local_path) as source:
+        for _, block in iter_file_chunks(source, DROPBOX_CONTENT_HASH_BLOCK_SIZE):
+            block_hashes.update(hashlib.sha256(block).digest())
+    return block_hashes.hexdigest()
+
+class DropboxPublishBatch:
+    """Publishes output files through Dropbox upload sessions committed in a single batch.
+
+    Each output's bytes are uploaded into its own closed upload session as soon as it is staged.
+    The commits (which serialize on Dropbox's namespace lock) are deferred and applied together
+    with files_upload_session_finish_batch_v2, once the batch window elapses or at the end of the
+    run. Results are tracked per entry; a video counts as published only if all of its entries
+    were committed.
+    """
+
+    def __init__(self, dbx_client, window_seconds, max_entries):
+        self.dbx_client = dbx_client
+        self.window_seconds = window_seconds
+        self.max_entries = max_entries
+        self.pending = [] # (video_key, target_path, UploadSessionFinishArg)
+        self.complete_videos = {} # video_key -> whether every expected output was staged (or unchanged)
+        self.first_staged_time = None
+        self.skipped_count = 0
+
+    def _upload_to_session(self, local_path):
+        """Uploads a local file into a new closed upload session. Returns the finished cursor."""
+        with mapped_file(local_path) as source:
+            if len(source) == 0:
+                session = self.dbx_client.files_upload_session_start(b'', close=True)
+                return dropbox.files.UploadSessionCursor(session_id=session.session_id, offset=0)
+            cursor = None
+            for offset, chunk in iter_file_chunks(source, DROPBOX_UPLOAD_CHUNK_SIZE):
+                is_last_chunk = offset + len(chunk) >= len(source)
+                if cursor is None:
+                    session = self.dbx_client.files_upload_session_start(chunk, close=is_last_chunk)
+                    cursor = dropbox.files.UploadSessionCursor(session_id=session.session_id, offset=0)
+                else:
+                    self.dbx_client.files_upload_session_append_v2(chunk, cursor, close=is_last_chunk)
+                cursor.offset = offset + len(chunk)
+            return cursor
+
+    def stage_outputs(self, video_key, outputs, complete=True):
+        """Uploads outputs [(local_path, dropbox_target_path, property_groups), ...] for one video.
+
+        Pass complete=False when some expected output could not be produced, so the video is
+        not reported as published. Returns True if every output was staged.
+        """
+        staged = []
+        for local_path, dropbox_target_path, property_groups in outputs:
+            # Skip outputs whose bytes are identical to what Dropbox already has (no write, no sync churn)
+            local_content_hash = dropbox_content_hash(local_path)
+            if local_content_hash == published_output_hashes.get(dropbox_target_path.lower()):
+                print(f"Skipping upload of '{os.path.basename(local_path)}': unchanged from '{dropbox_target_path}'.")
+                self.skipped_count += 1
+                continue
+            print(f"Staging '{os.path.basename(local_path)}' for batch commit to Dropbox path '{dropbox_target_path}'...")
+            try:
+                cursor = self._upload_to_session(local_path)
+            except CircuitOpenError:
+                raise
+            except Exception as e:
+                print(f"Error uploading '{local_path}' to a Dropbox upload session: {e}")
+                return False
+            commit = dropbox.files.CommitInfo(
+                path=dropbox_target_path,
+                mode=dropbox.files.WriteMode('overwrite'),
+                mute=True,
+                property_groups=property_groups
+            )
+            staged.append((video_key, dropbox_target_path, dropbox.files.UploadSessionFinishArg(cursor=cursor, commit=commit)))
+
+        self.pending.extend(staged)
+        self.complete_videos[video_key] = complete
+        if self.first_staged_time is None:
+            self.first_staged_time = time.time()
+        return True
+
+    def commit_if_due(self):
+        """Commits the batch when the window has elapsed or it is full. Returns the published video keys."""
+        if not self.pending:
+            # Videos whose outputs were all unchanged need no commit
+            return self.commit()
+        if len(self.pending) >= self.max_entries or time.time() - self.first_staged_time >= self.window_seconds:
+            return self.commit()
+        return []
+
+    def commit(self):
+        """Commits all staged outputs in one finish_batch call. Returns the video keys fully published."""
+        if not self.pending and not self.complete_videos:
+            return []
+        pending, self.pending = self.pending, []
+        complete_videos, self.complete_videos = self.complete_videos, {}
+        self.first_staged_time = None
+
+        failed_videos = set()
+        try:
+            if pending:
+                print(f"\nCommitting {len(pending)} staged output file(s) to Dropbox in one batch...")
+                result = self.dbx_client.files_upload_session_finish_batch_v2([arg for _, _, arg in pending])
+            else:
+                result = None
+            for (video_key, target_path, _), entry in zip(pending, result.entries if result else []):
+                if entry.is_success():
+                    print(f"  - Committed '{target_path}'.")
+                    published_output_hashes[target_path.lower()] = entry.get_success().content_hash
+                else:
+                    published_output_hashes.pop(target_path.lower(), None)
+                    print(f"  - Error committing '{target_path}': {entry.get_failure()}")
+                    failed_videos.add(video_key)
+        except Exception as e:
+            print(f"Error committing Dropbox upload batch: {e}")
+            failed_videos.update(video_key for video_key, _, _ in pending)
+            for _, target_path, _ in pending:
+                published_output_hashes.pop(target_path.lower(), None)
+
+        published = []
+        for video_key, complete in complete_videos.items():
+            if complete and video_key not in failed_videos:
+                published.append(video_key)
+            elif complete:
+                print(f"Upload failed for one or both output files for '{video_key}'. NOT marking as fully processed in this run.")
+        return published
+
+# --- Pipeline State Store ---
+
+class StateStore:
+    """SQLite (WAL) job table with one row per watch-folder video.
+
+    Each row holds the video's identity (Dropbox file id and path), content hash, the last
+    completed stage, attempt count, per-stage timings, the Gemini file name and the hashes of
+    the published outputs. Every stage transition is committed as it happens, so a crash loses
+    at most the stage in progress.
+
+    With a journal_path, every changed job row is also appended (and fsync'd) to a JSON-lines
+    journal, so the changes of a run can be shipped without rewriting the whole database.
+    Small run-to-run settings (JSON values by key) live in the same database and journal.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            job_id INTEGER PRIMARY KEY,
+            file_id TEXT UNIQUE,
+            path_lower TEXT NOT NULL,
+            path_display TEXT NOT NULL,
+            content_hash TEXT,
+            size INTEGER,
+            duration_seconds REAL,
+            tenant TEXT,
+            first_started_at REAL,
+            server_modified TEXT,
+            stage TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            remote_retries INTEGER NOT NULL DEFAULT 0,
+            last_retry_error TEXT,
+            generation_seconds REAL,
+            gemini_file_name TEXT,
+            generated_text TEXT,
+            description_data TEXT,
+            prompt_version TEXT,
+            lease_owner TEXT,
+            lease_expires_at REAL,
+            output_md_hash TEXT,
+            output_html_hash TEXT,
+            last_error TEXT,
+            stage_timings TEXT NOT NULL DEFAULT '{}',
+            discovered_at REAL NOT NULL,
+            stage_started_at REAL,
+            updated_at REAL NOT NULL,
+            completed_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS idx_jobs_status_discovered ON jobs (status, discovered_at);
+        CREATE INDEX IF NOT EXISTS idx_jobs_stage_updated ON jobs (stage, updated_at);
+        CREATE INDEX IF NOT EXISTS idx_jobs_path_lower ON jobs (path_lower);
+        CREATE INDEX IF NOT EXISTS idx_jobs_content_hash ON jobs (content_hash);
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        );
+    """
+
+    def __init__(self, db_path, journal_path=None):
+        self.db_path = db_path
+        self.journal_path = journal_path
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        self._migrate()
+
+    def _migrate(self):
+        """Adds columns introduced after a database was created."""
+        existing = {row["name"] for row in self.conn.execute("PRAGMA table_info(jobs)")}
+        for column, column_type in (("generated_text", "TEXT"), ("description_data", "TEXT"), ("prompt_version", "TEXT"),
+                                    ("lease_owner", "TEXT"), ("lease_expires_at", "REAL"), ("duration_seconds", "REAL"),
+                                    ("tenant", "TEXT"), ("first_started_at", "REAL"),
+                                    ("remote_retries", "INTEGER NOT NULL DEFAULT 0"), ("last_retry_error", "TEXT"),
+                                    ("upload_url", "TEXT"), ("upload_offset", "INTEGER"), ("upload_size", "INTEGER"),
+                                    ("generation_seconds", "REAL")):
+            if column not in existing:
+                self.conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {column_type}")
+        # Keeps the hedging history lookup to the rows it returns, however large the archive
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_generation_updated ON jobs (updated_at) WHERE generation_seconds IS NOT NULL")
+        # Generated text is only needed until a video is published (older databases kept it)
+        self.conn.execute("UPDATE jobs SET generated_text = NULL, description_data = NULL WHERE status = ? AND generated_text IS NOT NULL", (STATUS_DONE,))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def _write(self, sql, params=()):
+        """Runs one write statement in its own transaction (committed immediately)."""
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                cursor = self.conn.execute(sql, params)
+                self.conn.execute("COMMIT")
+                return cursor
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def _journal_jobs(self, where_sql, params=()):
+        """Appends the current state of the matching job rows to the journal and fsyncs it."""
+        if not self.journal_path:
+            return
+        with self.lock:
+            rows = self.conn.execute(f"SELECT * FROM jobs WHERE {where_sql}", params).fetchall()
+            if not rows:
+                return
+            with open(self.journal_path, 'a', encoding='utf-8') as f:
+                for row in rows:
+                    job = {column: row[column] for column in row.keys() if column != "job_id"}
+                    f.write(json.dumps(job) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _journal_setting(self, setting):
+        """Appends a setting dict ({"setting": key, "value": JSON text, "updated_at": ...}) to the journal and fsyncs it."""
+        if not self.journal_path:
+            return
+        with self.lock:
+            with open(self.journal_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(setting) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def get_setting(self, key):
+        """Returns the decoded value of a setting, or None if it was never stored."""
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+        return json.loads(row["value"]) if row else None
+
+    def put_setting(self, key, value):
+        """Stores a JSON-serializable setting, replacing the previous value."""
+        setting = {"setting": key, "value": json.dumps(value), "updated_at": time.time()}
+        self._write("INSERT OR REPLACE INTO settings (key, value, updated_at) VALUES (?, ?, ?)", (key, setting["value"], setting["updated_at"]))
+        self._journal_setting(setting)
+
+    def take_journal(self):
+        """Returns the journaled changes not shipped yet (bytes) and empties the journal."""
+        with self.lock:
+            if not self.journal_path or not os.path.exists(self.journal_path):
+                return b''
+            with open(self.journal_path, 'rb') as f:
+                data = f.read()
+            os.remove(self.journal_path)
+            return data
+
+    def restore_journal(self, data):
+        """Puts changes that could not be shipped back in front of the journal."""
+        with self.lock:
+            newer = b''
+            if os.path.exists(self.journal_path):
+                with open(self.journal_path, 'rb') as f:
+                    newer = f.read()
+            with open(self.journal_path, 'wb') as f:
+                f.write(data + newer)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def get_job(self, file_entry):
+        """Returns the job row for a Dropbox FileMetadata (by file id, then by path), or None."""
+        with self.lock:
+            row = self.conn.execute("SELECT * FROM jobs WHERE file_id = ?", (file_entry.id,)).fetchone()
+            if row is None:
+                row = self.conn.execute(
+                    "SELECT * FROM jobs WHERE path_lower = ? AND file_id IS NULL", (file_entry.path_lower,)
+                ).fetchone()
+            return row
+
+    def upsert_discovered(self, file_entry):
+        """Records a watch-folder video. A changed content hash resets the job to be processed again."""
+        now = time.time()
+        row = self.get_job(file_entry)
+        if row is None:
+            cursor = self._write(
+                "INSERT INTO jobs (file_id, path_lower, path_display, content_hash, size, server_modified, stage, status, discovered_at, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (file_entry.id, file_entry.path_lower, file_entry.path_display, file_entry.content_hash, file_entry.size,
+                 file_entry.server_modified.isoformat(), STAGE_DISCOVERED, STATUS_PENDING, now, now),
+            )
+            self._journal_jobs("job_id = ?", (cursor.lastrowid,))
+        elif row["content_hash"] and row["content_hash"] != file_entry.content_hash:
+            self._write(
+                "UPDATE jobs SET file_id = ?, path_lower = ?, path_display = ?, content_hash = ?, size = ?, server_modified = ?,"
+                " stage = ?, status = ?, attempts = 0, gemini_file_name = NULL, generated_text = NULL, description_data = NULL,"
+                " prompt_version = NULL, last_error = NULL, stage_timings = '{}', upload_url = NULL, upload_offset = NULL, upload_size = NULL,"
+                " stage_started_at = NULL, updated_at = ?, completed_at = NULL WHERE job_id = ?",
+                (file_entry.id, file_entry.path_lower, file_entry.path_display, file_entry.content_hash, file_entry.size,
+                 file_entry.server_modified.isoformat(), STAGE_DISCOVERED, STATUS_PENDING, now, row["job_id"]),
+            )
+            self._journal_jobs("job_id = ?", (row["job_id"],))
+        elif (row["file_id"], row["path_display"], row["content_hash"], row["size"]) != (
+                file_entry.id, file_entry.path_display, file_entry.content_hash, file_entry.size):
+            # Renamed, moved, or first seen since the legacy import: refresh the identity only
+            self._write(
+                "UPDATE jobs SET file_id = ?, path_lower = ?, path_display = ?, content_hash = ?, size = ?, server_modified = ?, updated_at = ?"
+                " WHERE job_id = ?",
+                (file_entry.id, file_entry.path_lower, file_entry.path_display, file_entry.content_hash, file_entry.size,
+                 file_entry.server_modified.isoformat(), now, row["job_id"]),
+            )
+            self._journal_jobs("job_id = ?", (row["job_id"],))
+        return self.get_job(file_entry)
+
+    def set_tenant(self, file_entry, tenant_name):
+        """Records which tenant a video belongs to."""
+        row = self.get_job(file_entry)
+        if row is None or row["tenant"] == tenant_name:
+            return
+        self._write("UPDATE jobs SET tenant = ?, updated_at = ? WHERE job_id = ?", (tenant_name, time.time(), row["job_id"]))
+        self._journal_jobs("job_id = ?", (row["job_id"],))
+
+    def tenant_metrics(self, since):
+        """Returns {tenant: {status counts, completed since `since`, queue waits, times to description}}."""
+        metrics = {}
+        with self.lock:
+            rows = self.conn.execute("SELECT tenant, status, discovered_at, first_started_at, completed_at FROM jobs").fetchall()
+        for row in rows:
+            tenant_metrics = metrics.setdefault(row["tenant"] or "default", {"statuses": {}, "completed_recently": 0, "waits": [], "times_to_description": []})
+            tenant_metrics["statuses"][row["status"]] = tenant_metrics["statuses"].get(row["status"], 0) + 1
+            if row["first_started_at"]:
+                tenant_metrics["waits"].append(row["first_started_at"] - row["discovered_at"])
+            if row["completed_at"] and row["first_started_at"]:
+                tenant_metrics["times_to_description"].append(row["completed_at"] - row["discovered_at"])
+                if row["completed_at"] >= since:
+                    tenant_metrics["completed_recently"] += 1
+        return metrics
+
+    def record_duration(self, file_entry, duration_seconds):
+        """Stores a video's probed duration once it is known."""
+        row = self.get_job(file_entry)
+        if row is None or duration_seconds is None or row["duration_seconds"] == duration_seconds:
+            return
+        self._write("UPDATE jobs SET duration_seconds = ?, updated_at = ? WHERE job_id = ?", (duration_seconds, time.time(), row["job_id"]))
+        self._journal_jobs("job_id = ?", (row["job_id"],))
+
+    def completed_jobs(self, limit):
+        """Returns the most recently completed job rows (used for throughput history)."""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT * FROM jobs WHERE status = ? AND completed_at IS NOT NULL ORDER BY completed_at DESC LIMIT ?", (STATUS_DONE, limit)
+            ).fetchall()
+
+    def record_generation_latency(self, file_entry, latency_seconds):
+        """Stores how long the video's description request took (the hedging history)."""
+        self._write("UPDATE jobs SET generation_seconds = ?, updated_at = ? WHERE file_id = ?", (latency_seconds, time.time(), file_entry.id))
+        self._journal_jobs("file_id = ?", (file_entry.id,))
+
+    def recent_generation_latencies(self, limit):
+        """Returns the description request latencies (seconds) of the most recently updated jobs that have one."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT generation_seconds FROM jobs WHERE generation_seconds IS NOT NULL ORDER BY updated_at DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return [row["generation_seconds"] for row in rows]
+
+    def is_published(self, file_entry):
+        """Returns True when this video (same content) has already been published."""
+        row = self.get_job(file_entry)
+        return bool(row and row["status"] == STATUS_DONE and (row["content_hash"] is None or row["content_hash"] == file_entry.content_hash))
+
+    def start_attempt(self, file_entry):
+        """Marks a video as running and counts the attempt."""
+        now = time.time()
+        self._write(
+            "UPDATE jobs SET status = ?, attempts = attempts + 1, last_error = NULL, stage_started_at = ?,"
+            " first_started_at = COALESCE(first_started_at, ?), updated_at = ? WHERE file_id = ?",
+            (STATUS_RUNNING, now, now, now, file_entry.id),
+        )
+        self._journal_jobs("file_id = ?", (file_entry.id,))
+
+    def advance_stage(self, file_entry, stage, **fields):
+        """Commits a completed stage (with optional column updates) and records how long it took."""
+        now = time.time()
+        with self.lock:
+            row = self.get_job(file_entry)
+            if row is None:
+                return
+            timings = json.loads(row["stage_timings"])
+            if row["stage_started_at"]:
+                timings[stage] = round(now - row["stage_started_at"], 3)
+            assignments = ["stage = ?", "stage_timings = ?", "stage_started_at = ?", "updated_at = ?"]
+            params = [stage, json.dumps(timings), now, now]
+            for column, value in fields.items():
+                assignments.append(f"{column} = ?")
+                params.append(value)
+            if stage == STAGE_PUBLISHED:
+                assignments += ["status = ?", "completed_at = ?"]
+                params += [STATUS_DONE, now]
+            self._write(f"UPDATE jobs SET {', '.join(assignments)} WHERE job_id = ?", params + [row["job_id"]])
+            self._journal_jobs("job_id = ?", (row["job_id"],))
+
+    def set_lease(self, file_entry, lease_owner, lease_expires_at):
+        """Records (or clears, with None) which worker holds the lease on a job and until when."""
+        self._write(
+            "UPDATE jobs SET lease_owner = ?, lease_expires_at = ?, updated_at = ? WHERE file_id = ?",
+            (lease_owner, lease_expires_at, time.time(), file_entry.id),
+        )
+        self._journal_jobs("file_id = ?", (file_entry.id,))
+
+    def mark_pending(self, file_entry):
+        """Puts a job back in the queue (e.g. after preemption); its last completed stage is kept."""
+        self._write("UPDATE jobs SET status = ?, updated_at = ? WHERE file_id = ?", (STATUS_PENDING, time.time(), file_entry.id))
+        self._journal_jobs("file_id = ?", (file_entry.id,))
+
+    def mark_failed(self, file_entry, error_message):
+        """Records a failed attempt; the last completed stage is kept."""
+        self._write(
+            "UPDATE jobs SET status = ?, last_error = ?, updated_at = ? WHERE file_id = ?",
+            (STATUS_FAILED, str(error_message)[:1000], time.time(), file_entry.id),
+        )
+        self._journal_jobs("file_id = ?", (file_entry.id,))
+
+    def record_remote_retry(self, file_entry, error_message):
+        """Counts a retried remote call (transient error) against the video's job."""
+        self._write(
+            "UPDATE jobs SET remote_retries = remote_retries + 1, last_retry_error = ?, updated_at = ? WHERE file_id = ?",
+            (str(error_message)[:1000], time.time(), file_entry.id),
+        )
+        self._journal_jobs("file_id = ?", (file_entry.id,))
+
+    def clear_gemini_file_name(self, gemini_file_name):
+        """Forgets a Gemini file (e.g. after it was deleted)."""
+        with self.lock:
+            job_ids = [row["job_id"] for row in self.conn.execute("SELECT job_id FROM jobs WHERE gemini_file_name = ?", (gemini_file_name,))]
+            self._write("UPDATE jobs SET gemini_file_name = NULL, updated_at = ? WHERE gemini_file_name = ?", (time.time(), gemini_file_name))
+            for job_id in job_ids:
+                self._journal_jobs("job_id = ?", (job_id,))
+
+    def upload_session_for(self, file_entry):
+        """Returns the saved resumable upload session {upload_url, offset, size} for the video's content, or None."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT upload_url, upload_offset, upload_size FROM jobs WHERE (file_id = ? OR content_hash = ?) AND upload_url IS NOT NULL"
+                " ORDER BY updated_at DESC LIMIT 1", (file_entry.id, file_entry.content_hash),
+            ).fetchone()
+        if row is None:
+            return None
+        return {"upload_url": row["upload_url"], "offset": row["upload_offset"], "size": row["upload_size"]}
+
+    def set_upload_session(self, file_entry, upload_url, offset, size):
+        """Saves the resumable upload session on the video's job row."""
+        self._write(
+            "UPDATE jobs SET upload_url = ?, upload_offset = ?, upload_size = ?, updated_at = ? WHERE file_id = ?",
+            (upload_url, offset, size, time.time(), file_entry.id),
+        )
+        self._journal_jobs("file_id = ?", (file_entry.id,))
+
+    def clear_upload_session(self, file_entry):
+        """Forgets a finished or expired upload session, wherever it is saved for the video's content."""
+        where_sql = "(file_id = ? OR content_hash = ?) AND upload_url IS NOT NULL"
+        params = (file_entry.id, file_entry.content_hash)
+        with self.lock:
+            job_ids = [row["job_id"] for row in self.conn.execute(f"SELECT job_id FROM jobs WHERE {where_sql}", params)]
+            if not job_ids:
+                return
+            self._write(f"UPDATE jobs SET upload_url = NULL, upload_offset = NULL, upload_size = NULL, updated_at = ? WHERE {where_sql}", (time.time(),) + params)
+            self._journal_jobs(f"job_id IN ({', '.join('?' for _ in job_ids)})", job_ids)
+
+    def gemini_file_for_content(self, content_hash):
+        """Returns the most recently recorded Gemini file name for a content hash, or None."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT gemini_file_name FROM jobs WHERE content_hash = ? AND gemini_file_name IS NOT NULL ORDER BY updated_at DESC LIMIT 1",
+                (content_hash,),
+            ).fetchone()
+        return row["gemini_file_name"] if row else None
+
+    def import_legacy_paths(self, paths):
+        """Imports processed paths from the old processed_files.json as published jobs without a file id."""
+        now = time.time()
+        for path in paths:
+            cursor = self._write(
+                "INSERT INTO jobs (path_lower, path_display, stage, status, discovered_at, updated_at, completed_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (path.lower(), path, STAGE_PUBLISHED, STATUS_DONE, now, now, now),
+            )
+            self._journal_jobs("job_id = ?", (cursor.lastrowid,))
+
+    def snapshot(self, snapshot_path):
+        """Writes a consistent copy of the database (including un-checkpointed WAL pages) to snapshot_path."""
+        if os.path.exists(snapshot_path):
+            os.remove(snapshot_path)
+        with self.lock:
+            snapshot_conn = sqlite3.connect(snapshot_path)
+            try:
+                self.conn.backup(snapshot_conn)
+            finally:
+                snapshot_conn.close()
+
+    def merge_from(self, other_db_path):
+        """Merges jobs from another copy of the database; for jobs present in both, the newer updated_at wins.
+
+        Returns the number of local rows inserted or replaced.
+        """
+        other_conn = sqlite3.connect(other_db_path)
+        other_conn.row_factory = sqlite3.Row
+        try:
+            other_rows = [dict(row) for row in other_conn.execute("SELECT * FROM jobs")]
+            if other_conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'settings'").fetchone():
+                other_rows += [dict(row) for row in other_conn.execute("SELECT key AS setting, value, updated_at FROM settings")]
+        finally:
+            other_conn.close()
+        return self.merge_rows(other_rows)
+
+    def merge_rows(self, other_rows):
+        """Merges job and setting dicts (from another database or a journal) into the tables. Replaying a row twice is harmless.
+
+        Merged rows are not journaled again. Returns the number of rows that were inserted or replaced.
+        """
+        table_columns = {row["name"] for row in self.conn.execute("PRAGMA table_info(jobs)")} - {"job_id"}
+        changed = 0
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                for other in other_rows:
+                    if "setting" in other:
+                        local = self.conn.execute("SELECT updated_at FROM settings WHERE key = ?", (other["setting"],)).fetchone()
+                        if local is not None and other["updated_at"] <= local["updated_at"]:
+                            continue
+                        self.conn.execute(
+                            "INSERT OR REPLACE INTO settings (key, value, updated_at) VALUES (?, ?, ?)", (other["setting"], other["value"], other["updated_at"])
+                        )
+                        changed += 1
+                        continue
+                    columns = [column for column in other if column in table_columns]
+                    if other["file_id"] is not None:
+                        local = self.conn.execute("SELECT job_id, updated_at FROM jobs WHERE file_id = ?", (other["file_id"],)).fetchone()
+                    else:
+                        local = self.conn.execute(
+                            "SELECT job_id, updated_at FROM jobs WHERE path_lower = ? AND file_id IS NULL", (other["path_lower"],)
+                        ).fetchone()
+                    if local is None:
+                        self.conn.execute(
+                            f"INSERT INTO jobs ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})",
+                            [other[column] for column in columns],
+                        )
+                    elif other["updated_at"] > local["updated_at"]:
+                        self.conn.execute(
+                            f"UPDATE jobs SET {', '.join(f'{column} = ?' for column in columns)} WHERE job_id = ?",
+                            [other[column] for column in columns] + [local["job_id"]],
+                        )
+                    else:
+                        continue
+                    changed += 1
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return changed
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+
+    def failed_jobs(self):
+        """Returns the failed job rows, most recently updated first."""
+        with self.lock:
+            return self.conn.execute("SELECT * FROM jobs WHERE status = ? ORDER BY updated_at DESC", (STATUS_FAILED,)).fetchall()
+
+    def status_counts(self):
+        """Returns {status: number of jobs}."""
+        with self.lock:
+            return {row["status"]: row["n"] for row in self.conn.execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status")}
+
+# --- Dropbox State Backend ---
+# GitHub-hosted runners start with an empty workspace, so the state is kept in Dropbox as a
+# snapshot of the database plus a folder of journal segments. Each run uploads only its own
+# journal (the job rows it changed) as a new segment, so writes stay proportional to the work
+# done rather than to the archive size. Startup loads the snapshot plus all segments. Once the
+# segments pass a size threshold they are compacted: the merged database is written back as the
+# new snapshot with WriteMode.update(rev) (on a conflict, the newer snapshot is merged and the
+# write retried) and the compacted segments are deleted. Replaying a segment twice is harmless.
+
+def download_state_database(dbx_client, dropbox_path, local_path):
+    """Downloads the state database from Dropbox. Returns its rev, or None if it does not exist yet."""
+    try:
+        metadata, response = dbx_client.files_download(dropbox_path)
+    except dropbox.exceptions.ApiError as e:
+        if e.error.is_path() and e.error.get_path().is_not_found():
+            return None
+        raise
+    with open(local_path, 'wb') as f:
+        f.write(response.content)
+    return metadata.rev
+
+def pull_state_from_dropbox(dbx_client, dropbox_path, local_path):
+    """Loads the Dropbox copy of the state database into local_path. Returns its rev (None if absent).
+
+    When a local database already exists (e.g. on a self-hosted runner), the Dropbox copy is merged into it.
+    """
+    remote_copy_path = f"{local_path}.remote"
+    rev = download_state_database(dbx_client, dropbox_path, remote_copy_path)
+    if rev is None:
+        print(f"No state database at '{dropbox_path}' yet. Starting from local state.")
+        return None
+    if os.path.exists(local_path):
+        local_store = StateStore(local_path)
+        try:
+            merged = local_store.merge_from(remote_copy_path)
+        finally:
+            local_store.close()
+        os.remove(remote_copy_path)
+        print(f"Merged state database from '{dropbox_path}' (rev {rev}) into local state ({merged} job(s) updated).")
+    else:
+        os.replace(remote_copy_path, local_path)
+        print(f"Loaded state database from '{dropbox_path}' (rev {rev}).")
+    return rev
+
+def push_state_to_dropbox(dbx_client, store, dropbox_path, rev, max_attempts):
+    """Writes the state database back to Dropbox without clobbering concurrent runs. Returns the new rev.
+
+    Uploads with WriteMode.update(rev) (or add, when the file did not exist). On a conflict, the
+    current Dropbox copy is merged into the local database and the upload is retried. Raises when
+    the upload still conflicts after max_attempts.
+    """
+    snapshot_path = f"{store.db_path}.snapshot"
+    try:
+        for attempt in range(1, max_attempts + 1):
+            store.snapshot(snapshot_path)
+            with open(snapshot_path, 'rb') as f:
+                data = f.read()
+            mode = dropbox.files.WriteMode.update(rev) if rev else dropbox.files.WriteMode.add
+            try:
+                metadata = dbx_client.files_upload(data, dropbox_path, mode=mode, mute=True)
+                print(f"Saved state database to '{dropbox_path}' ({len(data)} bytes, rev {metadata.rev}).")
+                return metadata.rev
+            except dropbox.exceptions.ApiError as e:
+                if not (e.error.is_path() and e.error.get_path().reason.is_conflict()):
+                    raise
+            print(f"State database in Dropbox changed since rev {rev} (attempt {attempt}/{max_attempts}). Merging and retrying...")
+            remote_copy_path = f"{store.db_path}.remote"
+            rev = download_state_database(dbx_client, dropbox_path, remote_copy_path)
+            if rev is not None:
+                merged = store.merge_from(remote_copy_path)
+                os.remove(remote_copy_path)
+                print(f"Merged {merged} job(s) from rev {rev}.")
+        raise RuntimeError(f"State database in Dropbox kept changing; gave up after {max_attempts} attempts.")
+    finally:
+        if os.path.exists(snapshot_path):
+            os.remove(snapshot_path)
+
+def pull_journal_from_dropbox(dbx_client, journal_folder_path, store):
+    """Replays every journal segment in Dropbox into the store. Returns [(segment path, size)]."""
+    try:
+        entries = list_dropbox_folder(dbx_client, journal_folder_path)
+    except dropbox.exceptions.ApiError as e:
+        if e.error.is_path() and e.error.get_path().is_not_found():
+            return []
+        raise
+    segments = sorted(
+        (entry for entry in entries if isinstance(entry, dropbox.files.FileMetadata) and entry.name.endswith('.jsonl')),
+        key=lambda entry: entry.name,
+    )
+    merged = 0
+    for entry in segments:
+        _, response = dbx_client.files_download(entry.path_lower)
+        rows = [json.loads(line) for line in response.content.decode('utf-8').splitlines() if line.strip()]
+        merged += store.merge_rows(rows)
+    if segments:
+        print(f"Replayed {len(segments)} state journal segment(s) from '{journal_folder_path}' ({merged} change(s) applied).")
+    return [(entry.path_lower, entry.size) for entry in segments]
+
+def upload_journal_segment(dbx_client, store, journal_folder_path):
+    """Uploads the store's unshipped journal as a new, uniquely named segment. Returns (path, size), or None.
+
+    If the upload fails, the changes go back into the local journal for the next attempt.
+    """
+    data = store.take_journal()
+    if not data:
+        return None
+    segment_name = f"{time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())}-{os.urandom(4).hex()}.jsonl"
+    segment_path = f"{journal_folder_path}/{segment_name}"
+    try:
+        dbx_client.files_upload(data, segment_path, mode=dropbox.files.WriteMode.add, mute=True)
+    except Exception:
+        store.restore_journal(data)
+        raise
+    change_count = len(data.splitlines())
+    print(f"Saved state journal segment '{segment_path}' ({change_count} change(s), {len(data)} bytes).")
+    return (segment_path.lower(), len(data))
+
+def delete_journal_segments(dbx_client, segment_paths):
+    """Deletes compacted journal segments. Segments already deleted by a concurrent compaction are ignored."""
+    for segment_path in segment_paths:
+        try:
+            dbx_client.files_delete_v2(segment_path)
+        except dropbox.exceptions.ApiError as e:
+            if not (e.error.is_path_lookup() and e.error.get_path_lookup().is_not_found()):
+                print(f"Warning: Could not delete compacted journal segment '{segment_path}': {e}")
+
+def save_state():
+    """Writes this run's state changes to the configured backend (a no-op for the local backend).
+
+    Uploads the run's journal as a new segment, and compacts the segments into a new snapshot once
+    they pass STATE_COMPACT_AFTER_SEGMENTS or STATE_COMPACT_AFTER_BYTES.
+    """
+    global state_rev
+    if STATE_BACKEND != STATE_BACKEND_DROPBOX:
+        return
+    try:
+        segment = upload_journal_segment(dbx, state_store, STATE_JOURNAL_FOLDER_PATH)
+        if segment:
+            state_journal_segments.append(segment)
+        journal_bytes = sum(size for _, size in state_journal_segments)
+        if len(state_journal_segments) < STATE_COMPACT_AFTER_SEGMENTS and journal_bytes < STATE_COMPACT_AFTER_BYTES:
+            return
+        print(f"Compacting {len(state_journal_segments)} state journal segment(s) ({journal_bytes} bytes) into a new snapshot...")
+        state_rev = push_state_to_dropbox(dbx, state_store, STATE_DROPBOX_PATH, state_rev, STATE_MAX_PUSH_ATTEMPTS)
+        delete_journal_segments(dbx, [segment_path for segment_path, _ in state_journal_segments])
+        state_journal_segments.clear()
+    except Exception as e:
+        print(f"Warning: Error saving state to Dropbox: {e}")
+
+def checkpoint_state(reason):
+    """Ships the journal to Dropbox right away (a no-op for the local backend).
+
+    The local journal and database are lost with a killed runner. Videos are checkpointed once, after
+    generation, the stage that is most expensive to redo; earlier stages (the Gemini upload session
+    and file) ship with that segment or at the end of the run. Each checkpoint adds a segment that
+    every startup has to replay until the next compaction, so checkpoints are kept few.
+    """
+    if STATE_BACKEND != STATE_BACKEND_DROPBOX:
+        return
+    try:
+        segment = upload_journal_segment(dbx, state_store, STATE_JOURNAL_FOLDER_PATH)
+        if segment:
+            state_journal_segments.append(segment)
+    except Exception as e:
+        print(f"Warning: Could not checkpoint state to Dropbox after {reason}: {e}. The changes are kept for the end of the run.")
+
+# --- Sharding ---
+# With --shard i/N each run only handles the videos whose file-ID hash falls in its shard and keeps
+# its own state database and journal, so N jobs can split a backlog without any coordination.
+
+def shard_of(file_id, shard_count):
+    """Returns the shard (0..shard_count-1) a Dropbox file id belongs to; stable across runs and machines."""
+    return int(hashlib.sha256(file_id.encode('utf-8')).hexdigest()[:16], 16) % shard_count
+
+def in_this_shard(file_entry):
+    return SHARD_COUNT == 1 or shard_of(file_entry.id, SHARD_COUNT) == SHARD_INDEX
+
+def shard_file_path(path, shard_index, shard_count):
+    """Returns the per-shard variant of a state file path (unchanged when unsharded)."""
+    if shard_count == 1:
+        return path
+    root, extension = os.path.splitext(path)
+    return f"{root}.shard-{shard_index}-of-{shard_count}{extension}"
+
+def shard_folder_path(path, shard_index, shard_count):
+    """Returns the per-shard variant of a state folder path (unchanged when unsharded)."""
+    if shard_count == 1:
+        return path
+    return f"{path}/shard-{shard_index}-of-{shard_count}"
+
+def load_shard_state(shard_index, shard_count):
+    """Opens a read-only view of one shard's state (a temporary copy for the Dropbox backend), or None."""
+    local_path = shard_file_path(PIPELINE_STATE_DB_FILE, shard_index, shard_count)
+    if STATE_BACKEND == STATE_BACKEND_LOCAL:
+        return StateStore(local_path) if os.path.exists(local_path) else None
+    report_path = f"{local_path}.report"
+    for leftover in (report_path, f"{report_path}-wal", f"{report_path}-shm"):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+    pull_state_from_dropbox(dbx, shard_file_path(STATE_DROPBOX_PATH_BASE, shard_index, shard_count), report_path)
+    store = StateStore(report_path)
+    pull_journal_from_dropbox(dbx, shard_folder_path(STATE_JOURNAL_FOLDER_PATH_BASE, shard_index, shard_count), store)
+    return store
+
+def print_shard_status_report(shard_count):
+    """Prints job counts per shard and merged across all shards, plus the failed jobs."""
+    print(f"\nJob status across {shard_count} shard(s):")
+    totals = {}
+    tenant_totals = {}
+    failed = []
+    for shard_index in range(shard_count):
+        store = load_shard_state(shard_index, shard_count)
+        if store is None:
+            print(f"  - Shard {shard_index}/{shard_count}: no state yet")
+            continue
+        counts = store.status_counts()
+        for status, count in counts.items():
+            totals[status] = totals.get(status, 0) + count
+        failed.extend(store.failed_jobs())
+        for tenant_name, tenant_metrics in store.tenant_metrics(time.time() - 24 * 3600).items():
+            merged = tenant_totals.setdefault(tenant_name, {"statuses": {}, "completed_recently": 0, "waits": [], "times_to_description": []})
+            for status, count in tenant_metrics["statuses"].items():
+                merged["statuses"][status] = merged["statuses"].get(status, 0) + count
+            merged["completed_recently"] += tenant_metrics["completed_recently"]
+            merged["waits"] += tenant_metrics["waits"]
+            merged["times_to_description"] += tenant_metrics["times_to_description"]
+        print(f"  - Shard {shard_index}/{shard_count}: {', '.join(f'{count} {status}' for status, count in sorted(counts.items())) or 'no jobs'}")
+        store.close()
+        if STATE_BACKEND == STATE_BACKEND_DROPBOX:
+            # Drop the temporary copy made for the report
+            for report_file in (store.db_path, f"{store.db_path}-wal", f"{store.db_path}-shm"):
+                if os.path.exists(report_file):
+                    os.remove(report_file)
+    print(f"  = All shards: {', '.join(f'{count} {status}' for status, count in sorted(totals.items())) or 'no jobs'}")
+    if TENANTS_ENABLED and tenant_totals:
+        print("Per tenant (completed in the last 24 hours, median queue wait, median time to description):")
+        for tenant_name, tenant_metrics in sorted(tenant_totals.items()):
+            waits = sorted(tenant_metrics["waits"])
+            times_to_description = sorted(tenant_metrics["times_to_description"])
+            median_wait = f"{waits[len(waits) // 2] / 60:.1f} min" if waits else "n/a"
+            median_time_to_description = f"{times_to_description[len(times_to_description) // 2] / 60:.1f} min" if times_to_description else "n/a"
+            print(f"  - {tenant_name}: {', '.join(f'{count} {status}' for status, count in sorted(tenant_metrics['statuses'].items()))};"
+                  f" {tenant_metrics['completed_recently']} completed, wait {median_wait}, time to description {median_time_to_description}")
+    if failed:
+        print("Failed jobs:")
+        for job in failed:
+            print(f"  - {job['path_display']} (stage {job['stage']}, {job['attempts']} attempt(s), {job['remote_retries']} remote retr{'y' if job['remote_retries'] == 1 else 'ies'}): {job['last_error']}")
+
+# --- Work Queue ---
+# Several runners (matrix jobs or machines) can work through the same watch folder. A worker
+# claims a video by creating its lease file in Dropbox with WriteMode.add, renews it from a
+# heartbeat thread with WriteMode.update(rev), and on success overwrites it with a done record
+# (so a worker whose listing predates the publish does not redo the video); on failure the lease
+# is deleted so another worker can retry. A lease that was not renewed in time is reclaimed by
+# overwriting it against the rev that was read, so exactly one reclaimer wins.
+
+class WorkQueue:
+    """Time-limited Dropbox leases on watch-folder videos, mirrored into the state store."""
+
+    def __init__(self, dbx_client, lease_folder_path, owner, lease_seconds, heartbeat_seconds):
+        self.dbx_client = dbx_client
+        self.lease_folder_path = lease_folder_path
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.held = {} # file id -> (file_entry, lease file rev)
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.heartbeat_thread = None
+
+    def _lease_path(self, file_entry):
+        return f"{self.lease_folder_path}/{file_entry.id.replace('id:', '')}.json"
+
+    def _write_lease(self, file_entry, mode, **record):
+        record = dict(record, owner=self.owner, path=file_entry.path_display, content_hash=file_entry.content_hash)
+        try:
+            metadata = self.dbx_client.files_upload(json.dumps(record).encode('utf-8'), self._lease_path(file_entry), mode=mode, mute=True)
+        except dropbox.exceptions.ApiError as e:
+            if e.error.is_path() and e.error.get_path().reason.is_conflict():
+                return None
+            raise
+        return metadata.rev
+
+    def _read_lease(self, file_entry):
+        """Returns (record, rev) of the current lease file, or (None, None) if there is none."""
+        try:
+            metadata, response = self.dbx_client.files_download(self._lease_path(file_entry))
+        except dropbox.exceptions.ApiError as e:
+            if e.error.is_path() and e.error.get_path().is_not_found():
+                return None, None
+            raise
+        try:
+            return json.loads(response.content), metadata.rev
+        except ValueError:
+            return {}, metadata.rev
+
+    def _update_lease(self, file_entry, rev, **record):
+        """Rewrites this worker's lease file. Returns the new rev, or None when another worker took the lease over.
+
+        A conflict can also mean that an earlier write of ours went through but its response was
+        lost. The lease file then still names this worker and is updated at its current rev.
+        """
+        new_rev = self._write_lease(file_entry, dropbox.files.WriteMode.update(rev), **record)
+        if new_rev is not None:
+            return new_rev
+        current, current_rev = self._read_lease(file_entry)
+        if current is None or current.get("owner") != self.owner:
+            return None
+        return self._write_lease(file_entry, dropbox.files.WriteMode.update(current_rev), **record)
+
+    def claim(self, file_entry):
+        """Tries to lease a video for this worker. Returns False when another worker holds or finished it."""
+        expires_at = time.time() + self.lease_seconds
+        rev = self._write_lease(file_entry, dropbox.files.WriteMode.add, state="leased", expires_at=expires_at)
+        if rev is None:
+            record, current_rev = self._read_lease(file_entry)
+            if record is None:
+                return False # Released between our write and read; the next run picks it up
+            if record.get("state") == "done" and record.get("content_hash") == file_entry.content_hash \
+                    and record.get("prompt_version") == PROMPT_VERSION:
+                print(f"Skipping {file_entry.path_display}: already published by worker {record.get('owner')}.")
+                return False
+            if record.get("state") == "leased" and record.get("owner") != self.owner and record.get("expires_at", 0) > time.time():
+                print(f"Skipping {file_entry.path_display}: leased by worker {record.get('owner')} until {datetime.utcfromtimestamp(record['expires_at']).isoformat()} UTC.")
+                return False
+            if record.get("state") == "leased" and record.get("owner") != self.owner:
+                print(f"Reclaiming expired lease on {file_entry.path_display} from worker {record.get('owner')}.")
+            rev = self._write_lease(file_entry, dropbox.files.WriteMode.update(current_rev), state="leased", expires_at=expires_at)
+            if rev is None:
+                print(f"Skipping {file_entry.path_display}: another worker claimed it first.")
+                return False
+        with self.lock:
+            self.held[file_entry.id] = (file_entry, rev)
+        state_store.set_lease(file_entry, self.owner, expires_at)
+        print(f"Leased {file_entry.path_display} for {self.lease_seconds}s as worker {self.owner}.")
+        return True
+
+    def holds(self, file_entry):
+        with self.lock:
+            return file_entry.id in self.held
+
+    def renew_all(self):
+        """Extends every lease this worker holds. A lease that was reclaimed in the meantime is dropped."""
+        with self.lock:
+            held = list(self.held.values())
+        for file_entry, rev in held:
+            expires_at = time.time() + self.lease_seconds
+            try:
+                new_rev = self._update_lease(file_entry, rev, state="leased", expires_at=expires_at)
+            except Exception as e:
+                print(f"Warning: Error renewing lease on {file_entry.path_display}: {e}")
+                continue
+            with self.lock:
+                if file_entry.id not in self.held:
+                    continue
+                if new_rev is None:
+                    print(f"Warning: Lost the lease on {file_entry.path_display} to another worker.")
+                    self.held.pop(file_entry.id)
+                    continue
+                self.held[file_entry.id] = (file_entry, new_rev)
+            state_store.set_lease(file_entry, self.owner, expires_at)
+
+    def complete(self, file_entry):
+        """Replaces the lease with a done record once the video's outputs are published."""
+        with self.lock:
+            _, rev = self.held.pop(file_entry.id, (None, None))
+        if rev is None:
+            return
+        try:
+            self._update_lease(file_entry, rev, state="done", prompt_version=PROMPT_VERSION, completed_at=time.time())
+        except Exception as e:
+            print(f"Warning: Error recording completion of {file_entry.path_display} in the work queue: {e}")
+        state_store.set_lease(file_entry, None, None)
+
+    def release(self, file_entry):
+        """Gives up a lease (e.g. after a failure) so another worker can retry the video."""
+        with self.lock:
+            _, rev = self.held.pop(file_entry.id, (None, None))
+        if rev is None:
+            return
+        try:
+            self.dbx_client.files_delete_v2(self._lease_path(file_entry), parent_rev=rev)
+        except Exception as e:
+            print(f"Warning: Error releasing lease on {file_entry.path_display}: {e}")
+        state_store.set_lease(file_entry, None, None)
+
+    def start_heartbeat(self):
+        def heartbeat():
+            while not self.stop_event.wait(self.heartbeat_seconds):
+                self.renew_all()
+        self.heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+        self.heartbeat_thread.start()
+
+    def shutdown(self):
+        """Stops the heartbeat and releases any leases still held."""
+        self.stop_event.set()
+        if self.heartbeat_thread:
+            self.heartbeat_thread.join(timeout=self.heartbeat_seconds)
+        with self.lock:
+            remaining = [file_entry for file_entry, _ in self.held.values()]
+        for file_entry in remaining:
+            self.release(file_entry)
+
+# --- Run Lock ---
+# A scheduled run can still be busy (e.g. in the Gemini wait loop) when the next cron run starts.
+# The run lock is a Dropbox file created with WriteMode.add and renewed by a heartbeat; a lock
+# whose expiry has passed (its run was killed) is taken over against the rev that was read.
+
+class RunLock:
+    """Run-level mutual exclusion through a Dropbox lock file with a TTL."""
+
+    def __init__(self, dbx_client, lock_path, owner, ttl_seconds, heartbeat_seconds):
+        self.dbx_client = dbx_client
+        self.lock_path = lock_path
+        self.owner = owner
+        self.ttl_seconds = ttl_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.rev = None
+        self.holder = None # Lock record of the run holding the lock when acquire() fails
+        self.stop_event = threading.Event()
+        self.heartbeat_thread = None
+
+    def _write(self, mode):
+        record = {"owner": self.owner, "acquired_at": time.time(), "expires_at": time.time() + self.ttl_seconds}
+        try:
+            return self.dbx_client.files_upload(json.dumps(record).encode('utf-8'), self.lock_path, mode=mode, mute=True).rev
+        except dropbox.exceptions.ApiError as e:
+            if e.error.is_path() and e.error.get_path().reason.is_conflict():
+                return None
+            raise
+
+    def acquire(self):
+        """Takes the lock (or an expired one). Returns False when another run holds it."""
+        write_error = None
+        try:
+            self.rev = self._write(dropbox.files.WriteMode.add)
+        except Exception as e:
+            if not is_transient_error(e):
+                raise
+            # The lock file may have been written even though the response was lost; its holder tells
+            write_error = e
+            self.rev = None
+        if self.rev is None:
+            self.holder, current_rev = self._read()
+            if self.holder is None:
+                if write_error:
+                    raise write_error
+                return self.acquire() # Released in the meantime
+            if self.holder.get("owner") == self.owner:
+                # Our own write went through even though its response was lost
+                self.rev = current_rev
+            elif self.holder.get("expires_at", 0) > time.time():
+                return False
+            else:
+                print(f"Taking over expired run lock from {self.holder.get('owner')}.")
+                self.rev = self._write(dropbox.files.WriteMode.update(current_rev))
+                if self.rev is None:
+                    return False
+        self.heartbeat_thread = threading.Thread(target=self._heartbeat, daemon=True)
+        self.heartbeat_thread.start()
+        return True
+
+    def _read(self):
+        """Returns (record, rev) of the current lock file, or (None, None) if there is none."""
+        try:
+            metadata, response = self.dbx_client.files_download(self.lock_path)
+        except dropbox.exceptions.ApiError as e:
+            if e.error.is_path() and e.error.get_path().is_not_found():
+                return None, None
+            raise
+        try:
+            return json.loads(response.content), metadata.rev
+        except ValueError:
+            return {}, metadata.rev
+
+    def _current_rev_if_ours(self):
+        """After a conflict: returns the lock file's rev if it still names this run (a write whose response was lost), else None."""
+        record, rev = self._read()
+        return rev if record is not None and record.get("owner") == self.owner else None
+
+    def _heartbeat(self):
+        while not self.stop_event.wait(self.heartbeat_seconds):
+            try:
+                new_rev = self._write(dropbox.files.WriteMode.update(self.rev))
+                if new_rev is None:
+                    current_rev = self._current_rev_if_ours()
+                    if current_rev is not None:
+                        new_rev = self._write(dropbox.files.WriteMode.update(current_rev))
+            except Exception as e:
+                print(f"Warning: Error renewing run lock: {e}")
+                continue
+            if new_rev is None:
+                print("Warning: Run lock was taken over by another run.")
+                return
+            self.rev = new_rev
+
+    def release(self):
+        """Releases the lock if this run holds it."""
+        if self.rev is None:
+            return
+        self.stop_event.set()
+        if self.heartbeat_thread:
+            self.heartbeat_thread.join(timeout=self.heartbeat_seconds)
+        try:
+            try:
+                self.dbx_client.files_delete_v2(self.lock_path, parent_rev=self.rev)
+            except dropbox.exceptions.ApiError:
+                # Our last renewal may have gone through with its response lost
+                current_rev = self._current_rev_if_ours()
+                if current_rev is None:
+                    raise
+                self.dbx_client.files_delete_v2(self.lock_path, parent_rev=current_rev)
+            print("Released run lock.")
+        except Exception as e:
+            print(f"Warning: Error releasing run lock: {e}")
+        self.rev = None
+
+# --- Prompt Versioning and Output Stamps ---
+
+def compute_prompt_version(template_text, example_text, config):
+    """Returns a short content hash of the prompt template, example output and output-affecting config."""
+    versioned_config = {key: config.get(key) for key in PROMPT_VERSION_CONFIG_KEYS}
+    hasher = hashlib.sha256()
+    for part in (template_text, example_text, json.dumps(versioned_config, sort_keys=True)):
+        hasher.update(part.encode('utf-8'))
+        hasher.update(b'\0')
+    return hasher.hexdigest()[:16]
+
+def build_output_stamp(file_entry):
+    """Builds the stamp recorded with every published description."""
+    return {
+        "prompt_version": PROMPT_VERSION,
+        "model_name": GEMINI_MODEL_NAME,
+        "source_content_hash": getattr(file_entry, 'content_hash', None) or '',
+        "source_path": file_entry.path_display,
+    }
+
+def embed_output_stamp(content, stamp, html_output=False):
+    """Embeds a stamp as an HTML comment (invisible when rendered) in a markdown or HTML output."""
+    comment = f"<!-- {OUTPUT_STAMP_MARKER} {json.dumps(stamp, sort_keys=True)} -->"
+    if html_output:
+        return f"{comment}\n{content}"
+    return f"{content.rstrip()}\n\n{comment}\n"
+
+def parse_output_stamp(content):
+    """Extracts an embedded stamp from output content. Returns a dict or None."""
+    match = OUTPUT_STAMP_PATTERN.search(content)
+    if not match:
+        return None
+    try:
+        return json.loads(match.group(1))
+    except json.JSONDecodeError:
+        return None
+
+def get_stamp_property_template_id(dbx_client):
+    """Finds (or creates) the Dropbox file property template used to stamp outputs.
+
+    Returns the template id, or None when file properties are unavailable for this token
+    (stamps are then only embedded in the output content).
+    """
+    try:
+        for template_id in dbx_client.file_properties_templates_list_for_user().template_ids:
+            if dbx_client.file_properties_templates_get_for_user(template_id).name == OUTPUT_STAMP_PROPERTY_TEMPLATE_NAME:
+                return template_id
+        result = dbx_client.file_properties_templates_add_for_user(
+            OUTPUT_STAMP_PROPERTY_TEMPLATE_NAME,
+            "Prompt version and source video of a generated description",
+            [dropbox.file_properties.PropertyFieldTemplate(field, field, dropbox.file_properties.PropertyType.string) for field in OUTPUT_STAMP_FIELDS],
+        )
+        print(f"Created Dropbox property template '{OUTPUT_STAMP_PROPERTY_TEMPLATE_NAME}' for output stamps.")
+        return result.template_id
+    except Exception as e:
+        print(f"Warning: Dropbox file properties unavailable ({e}). Output stamps will only be embedded in the files.")
+        return None
+
+def stamp_property_groups(stamp):
+    """Returns the property_groups argument for uploading an output with a stamp, or None."""
+    if not STAMP_PROPERTY_TEMPLATE_ID:
+        return None
+    return [dropbox.file_properties.PropertyGroup(
+        STAMP_PROPERTY_TEMPLATE_ID,
+        [dropbox.file_properties.PropertyField(field, str(stamp.get(field, ''))[:1024]) for field in OUTPUT_STAMP_FIELDS],
+    )]
+
+def read_output_stamp(dbx_client, entry):
+    """Reads the stamp of a published markdown output from its property group, or its embedded comment."""
+    for group in getattr(entry, 'property_groups', None) or []:
+        if group.template_id == STAMP_PROPERTY_TEMPLATE_ID:
+            return {field.name: field.value for field in group.fields}
+    try:
+        _, res = dbx_client.files_download(path=entry.path_display)
+        return parse_output_stamp(res.content.decode('utf-8', errors='replace'))
+    except Exception as e:
+        print(f"Warning: Could not read stamp from {entry.path_display}: {e}")
+        return None
+
+def list_dropbox_folder(dbx_client, folder_path, **kwargs):
+    """Lists all entries of a Dropbox folder, following has_more pagination."""
+    result = dbx_client.files_list_folder(path=folder_path, **kwargs)
+    entries = list(result.entries)
+    while result.has_more:
+        result = dbx_client.files_list_folder_continue(result.cursor)
+        entries.extend(result.entries)
+    return entries
+
+def list_output_folder(dbx_client):
+    """Lists the output folder (with its mirrored subfolders) once, including stamp property groups when the template is available."""
+    include_property_groups = None
+    if STAMP_PROPERTY_TEMPLATE_ID:
+        include_property_groups = dropbox.file_properties.TemplateFilterBase.filter_some([STAMP_PROPERTY_TEMPLATE_ID])
+    return list_dropbox_folder(dbx_client, DROPBOX_OUTPUT_FOLDER_PATH, recursive=True, include_property_groups=include_property_groups)
+
+def output_entry_base_path(entry):
+    """Returns an output's lowercased path relative to the output folder, without extension (the reconcile key)."""
+    return os.path.splitext(entry.path_lower[len(DROPBOX_OUTPUT_FOLDER_PATH):].lstrip('/'))[0]
+
+def reconcile_published_outputs(output_entries):
+    """Builds output base path (lowercased, see output_base_path) -> stamp for every description published in the output folder.
+
+    Only base paths with both a .md and an .html output count as published. The stamp comes from
+    the property group of the .md (an empty dict when the output is unstamped). The listing also
+    rebuilds the content hashes used to skip unchanged uploads, so an output missing from them does not exist.
+    """
+    published_output_hashes.clear()
+    outputs_by_base_path = {}
+    for entry in output_entries:
+        if not isinstance(entry, dropbox.files.FileMetadata):
+            continue
+        ext = os.path.splitext(entry.name)[1].lower()
+        if ext not in ('.md', '.html'):
+            continue
+        published_output_hashes[entry.path_lower] = entry.content_hash
+        outputs = outputs_by_base_path.setdefault(output_entry_base_path(entry), {})
+        outputs[ext] = entry
+
+    published = {}
+    for base_path, outputs in outputs_by_base_path.items():
+        if '.md' in outputs and '.html' in outputs:
+            stamp = {}
+            for group in getattr(outputs['.md'], 'property_groups', None) or []:
+                if group.template_id == STAMP_PROPERTY_TEMPLATE_ID:
+                    stamp = {field.name: field.value for field in group.fields}
+            published[base_path] = stamp
+    return published
+
+def find_videos_to_process(entries, published_outputs, time_threshold, quiet=False):
+    """Returns the recent watch-folder videos that still need a description, recording each in the state store."""
+    videos = []
+    for entry in entries:
+        if isinstance(entry, dropbox.files.FileMetadata) and hasattr(entry, 'server_modified') and isinstance(entry.server_modified, datetime) and entry.server_modified.replace(tzinfo=None) > time_threshold:
+            if is_video_file(entry.name):
+                 state_store.upsert_discovered(entry)
+                 state_store.set_tenant(entry, tenant_of(entry)["name"])
+                 if state_store.is_published(entry):
+                      if not quiet: print(f"Skipping already processed video file: {entry.path_display} (Published according to state store)")
+                 elif is_already_published(entry, published_outputs):
+                      if not quiet: print(f"Skipping already processed video file: {entry.path_display} (Description exists in output folder)")
+                 else:
+                      print(f"Identified new/unprocessed video file: {entry.path_display} (Modified: {entry.server_modified})")
+                      videos.append(entry)
+        elif isinstance(entry, dropbox.files.FileMetadata) and not quiet:
+             print(f"Skipping old or invalid metadata file: {entry.path_display} (Modified: {getattr(entry, 'server_modified', 'N/A')})")
+    return videos
+
+def is_already_published(file_entry, published_outputs):
+    """Returns True when a description for this video already exists in the output folder.
+
+    A stamp recording a different source content hash means the video was replaced, so it is
+    processed again.
+    """
+    stamp = published_outputs.get(output_base_path(file_entry).lower())
+    if stamp is None:
+        return False
+    source_content_hash = stamp.get("source_content_hash")
+    return not source_content_hash or source_content_hash == getattr(file_entry, 'content_hash', None)
+
+# --- Gemini File Reuse ---
+# Successfully processed Gemini files are kept until they expire (48 hours) and their names are
+# recorded in the state store, so repair and reprocessing runs can reuse them instead of re-uploading.
+
+def find_cached_gemini_file(content_hash):
+    """Returns a still-ACTIVE Gemini file previously uploaded for this content hash, or None."""
+    file_name = state_store.gemini_file_for_content(content_hash) if content_hash else None
+    if not file_name:
+        return None
+    try:
+        file_obj = call_remote(REMOTE_API_GEMINI, genai.get_file, file_name)
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        print(f"Cached Gemini file {file_name} is no longer available ({e}).")
+        state_store.clear_gemini_file_name(file_name)
+        return None
+    if file_obj.state != 2: # ACTIVE
+        state_store.clear_gemini_file_name(file_name)
+        return None
+    print(f"Reusing cached Gemini file {file_obj.name} for content hash {content_hash}.")
+    return file_obj
+
+# --- Selective Reprocessing ---
+
+def find_stale_descriptions(dbx_client, watch_entries, output_entries):
+    """Finds published descriptions stamped with an older prompt version (or not stamped at all).
+
+    Returns a list of (source_entry, stamp) pairs, prioritized so that videos with a cached
+    transcript (cheap text-only requests) come first, then the most recently modified sources.
+    """
+    sources_by_path = {}
+    sources_by_base_path = {}
+    for entry in watch_entries:
+        if isinstance(entry, dropbox.files.FileMetadata) and is_video_file(entry.name):
+            sources_by_path[entry.path_lower] = entry
+            sources_by_base_path[output_base_path(entry).lower()] = entry
+
+    cached_transcript_hashes = set()
+    if TRANSCRIPT_CACHE_ENABLED:
+        try:
+            for entry in list_dropbox_folder(dbx_client, DROPBOX_TRANSCRIPT_FOLDER_PATH):
+                if entry.name.endswith('.transcript.md'):
+                    cached_transcript_hashes.add(entry.name[:-len('.transcript.md')])
+        except dropbox.exceptions.ApiError as e:
+            print(f"Warning: Could not list transcript folder: {e}")
+
+    stale = []
+    for entry in output_entries:
+        if not isinstance(entry, dropbox.files.FileMetadata) or not entry.name.endswith('.md'):
+            continue
+        stamp = read_output_stamp(dbx_client, entry) or {}
+        if stamp.get("prompt_version") == PROMPT_VERSION:
+            continue
+        source_entry = sources_by_path.get((stamp.get("source_path") or '').lower()) or sources_by_base_path.get(output_entry_base_path(entry))
+        if source_entry is None:
+            print(f"Stale description {entry.name} has no matching source video in the watch folder. Skipping.")
+            continue
+        stale.append((source_entry, stamp))
+
+    stale.sort(key=lambda item: (
+        item[0].content_hash not in cached_transcript_hashes,
+        -item[0].server_modified.timestamp(),
+    ))
+    return stale
+
+def reprocess_stale_descriptions(dbx_client, publish_batch, watch_entries, output_entries, limit, min_interval_seconds):
+    """Regenerates descriptions made by older prompt versions, at most `limit` per run and rate-limited."""
+    stale = find_stale_descriptions(dbx_client, watch_entries, output_entries)
+    print(f"Found {len(stale)} stale description(s) (current prompt version {PROMPT_VERSION}).")
+    if limit is not None and limit >= 0:
+        stale = stale[:limit]
+        print(f"Reprocessing up to {limit} of them in this run.")
+
+    sources_by_path = {source_entry.path_display: source_entry for source_entry, _ in stale}
+    published_paths = []
+    last_start_time = None
+    for source_entry, stamp in stale:
+        if last_start_time is not None:
+            wait_seconds = min_interval_seconds - (time.time() - last_start_time)
+            if wait_seconds > 0:
+                print(f"Rate limiting reprocessing: waiting {wait_seconds:.0f}s...")
+                time.sleep(wait_seconds)
+        unavailable = unavailable_backends()
+        if unavailable:
+            print(f"Stopping reprocessing: circuit breaker open for {', '.join(unavailable)}. The remaining descriptions are picked up in a later run.")
+            break
+        last_start_time = time.time()
+        print(f"Reprocessing {source_entry.path_display} (stamped version: {stamp.get('prompt_version', 'none')})")
+        state_store.upsert_discovered(source_entry)
+        if work_queue and not work_queue.claim(source_entry):
+            continue
+        try:
+            with remote_calls_for(source_entry):
+                process_video_entry(dbx_client, publish_batch, source_entry)
+        except CircuitOpenError as e:
+            print(f"Stopping reprocessing: {e} while processing {source_entry.name}. It is picked up in a later run.")
+            state_store.mark_pending(source_entry)
+            if work_queue:
+                work_queue.release(source_entry)
+            break
+        published_paths.extend(publish_batch.commit_if_due())
+    published_paths.extend(publish_batch.commit())
+    for published_path in published_paths:
+        mark_video_published(sources_by_path[published_path])
+    mark_unpublished_failed(sources_by_path.values(), published_paths)
+    reprocessed = len(published_paths)
+    print(f"Reprocessed {reprocessed} of {len(stale)} selected stale description(s).")
+    print_input_path_latency_summary()
+
 # --- Main Processing Logic ---
 
 # --- Load Configuration and Prompt Files ---
@@ -146,15 +3442,143 @@ final_prompt_string = prompt_template_content.replace('[INSERT_EXAMPLE_TEXT_HERE
 if '[INSERT_EXAMPLE_TEXT_HERE]' in final_prompt_string:
     print("Warning: Placeholder [INSERT_EXAMPLE_TEXT_HERE] not found in template. Prompt might be malformed.")
 
+# Required sections are taken from the example output so the validator follows template edits
+REQUIRED_SECTION_HEADERS = parse_section_headers(example_output_content)
+print(f"Required description sections: {', '.join(REQUIRED_SECTION_HEADERS) or 'None found in example'}")
+
 # Extract Gemini settings from config
 GEMINI_MODEL_NAME = gemini_config.get("model_name", "gemini-1.5-pro-latest") # Use the default confirmed working model
 raw_gen_config = gemini_config.get("generation_config", {})
 PROCESSING_TIMEOUT_SECONDS = gemini_config.get("processing_timeout_seconds", 1800) # Default to 30 min
+OUTPUT_FORMAT = gemini_config.get("output_format", OUTPUT_FORMAT_MARKDOWN)
+PROMPT_VERSION = compute_prompt_version(prompt_template_content, example_output_content, gemini_config)
+print(f"Prompt version: {PROMPT_VERSION}")
+reprocess_config = gemini_config.get("reprocess", {})
+REPROCESS_MAX_VIDEOS_PER_RUN = reprocess_config.get("max_videos_per_run", 20)
+REPROCESS_MIN_INTERVAL_SECONDS = reprocess_config.get("min_interval_seconds", 30)
+transcript_cache_config = gemini_config.get("transcript_cache", {})
+TRANSCRIPT_CACHE_ENABLED = transcript_cache_config.get("enabled", False)
+dropbox_upload_config = gemini_config.get("dropbox_upload", {})
+DROPBOX_PUBLISH_BATCH_WINDOW_SECONDS = dropbox_upload_config.get("batch_window_seconds", 600)
+# files_upload_session_finish_batch accepts at most 1000 entries
+DROPBOX_PUBLISH_BATCH_MAX_ENTRIES = min(1000, dropbox_upload_config.get("max_batch_entries", 1000))
+DROPBOX_UPLOAD_CHUNK_SIZE = max(
+    DROPBOX_UPLOAD_CHUNK_GRANULARITY,
+    dropbox_upload_config.get("chunk_size_bytes", 8 * 1024 * 1024) // DROPBOX_UPLOAD_CHUNK_GRANULARITY * DROPBOX_UPLOAD_CHUNK_GRANULARITY,
+)
+resumable_upload_config = gemini_config.get("resumable_upload", {})
+RESUMABLE_UPLOAD_CHUNK_SIZE = max(
+    RESUMABLE_UPLOAD_CHUNK_GRANULARITY,
+    resumable_upload_config.get("chunk_size_bytes", 8 * 1024 * 1024) // RESUMABLE_UPLOAD_CHUNK_GRANULARITY * RESUMABLE_UPLOAD_CHUNK_GRANULARITY,
+)
+RESUMABLE_UPLOAD_MAX_CHUNK_RETRIES = resumable_upload_config.get("max_chunk_retries", 3)
+inline_video_config = gemini_config.get("inline_video", {})
+INLINE_VIDEO_ENABLED = inline_video_config.get("enabled", True)
+INLINE_VIDEO_MAX_BYTES = inline_video_config.get("max_bytes", DEFAULT_INLINE_VIDEO_MAX_BYTES)
+hedging_config = gemini_config.get("hedging", {})
+HEDGING_ENABLED = hedging_config.get("enabled", False)
+HEDGING_PERCENTILE = hedging_config.get("percentile", 95)
+HEDGING_MIN_SAMPLES = hedging_config.get("min_samples", 20)
+HEDGING_MAX_PER_RUN = hedging_config.get("max_hedges_per_run", 3)
+state_backend_config = gemini_config.get("state_backend", {})
+STATE_BACKEND = state_backend_config.get("type", STATE_BACKEND_LOCAL)
+STATE_DROPBOX_PATH_BASE = state_backend_config.get("dropbox_path", DEFAULT_STATE_DROPBOX_PATH)
+STATE_MAX_PUSH_ATTEMPTS = state_backend_config.get("max_push_attempts", 3)
+STATE_JOURNAL_FOLDER_PATH_BASE = state_backend_config.get("journal_folder_path", f"{os.path.dirname(STATE_DROPBOX_PATH_BASE)}/journal")
+# Each shard keeps its own state database and journal
+STATE_DROPBOX_PATH = shard_file_path(STATE_DROPBOX_PATH_BASE, SHARD_INDEX, SHARD_COUNT)
+STATE_JOURNAL_FOLDER_PATH = shard_folder_path(STATE_JOURNAL_FOLDER_PATH_BASE, SHARD_INDEX, SHARD_COUNT)
+STATE_DB_FILE = shard_file_path(PIPELINE_STATE_DB_FILE, SHARD_INDEX, SHARD_COUNT)
+STATE_JOURNAL_FILE = shard_file_path(PIPELINE_STATE_JOURNAL_FILE, SHARD_INDEX, SHARD_COUNT)
+STATE_COMPACT_AFTER_SEGMENTS = state_backend_config.get("compact_after_segments", 10)
+STATE_COMPACT_AFTER_BYTES = state_backend_config.get("compact_after_bytes", 1024 * 1024)
+if STATE_BACKEND not in (STATE_BACKEND_LOCAL, STATE_BACKEND_DROPBOX):
+    print(f"Error: Unsupported state_backend type '{STATE_BACKEND}' in config. Use '{STATE_BACKEND_LOCAL}' or '{STATE_BACKEND_DROPBOX}'.")
+    exit(1)
+scheduler_config = gemini_config.get("scheduler", {})
+SCHEDULER_POLICY = scheduler_config.get("policy", SCHEDULER_POLICY_SJF)
+SCHEDULER_AGING_WEIGHT = scheduler_config.get("aging_weight", 0.5)
+SCHEDULER_HISTORY_SIZE = scheduler_config.get("history_size", 50)
+SCHEDULER_MIN_HISTORY = scheduler_config.get("min_history", 5)
+if SCHEDULER_POLICY not in (SCHEDULER_POLICY_SJF, SCHEDULER_POLICY_FIFO):
+    print(f"Error: Unsupported scheduler policy '{SCHEDULER_POLICY}' in config. Use '{SCHEDULER_POLICY_SJF}' or '{SCHEDULER_POLICY_FIFO}'.")
+    exit(1)
+priority_lanes_config = gemini_config.get("priority_lanes", {})
+PRIORITY_LANES_ENABLED = priority_lanes_config.get("enabled", False)
+PRIORITY_LANES = priority_lanes_config.get("lanes", []) if PRIORITY_LANES_ENABLED else []
+PRIORITY_LANES_POLL_SECONDS = priority_lanes_config.get("poll_seconds", 60)
+if not PRIORITY_LANES:
+    PRIORITY_LANES = [{"name": "default", "patterns": ["*"], "share": 1}]
+tenants_config = gemini_config.get("tenants", {})
+TENANTS_ENABLED = tenants_config.get("enabled", False)
+TENANTS = tenants_config.get("tenants", []) if TENANTS_ENABLED else []
+if not TENANTS:
+    TENANTS = [{"name": "default", "patterns": ["*"], "weight": 1}]
+run_lock_config = gemini_config.get("run_lock", {})
+RUN_LOCK_ENABLED = run_lock_config.get("enabled", False)
+RUN_LOCK_PATH = shard_file_path(run_lock_config.get("dropbox_path", f"{os.path.dirname(STATE_DROPBOX_PATH_BASE)}/run.lock"), SHARD_INDEX, SHARD_COUNT)
+RUN_LOCK_TTL_SECONDS = run_lock_config.get("ttl_seconds", 1800)
+RUN_LOCK_HEARTBEAT_SECONDS = run_lock_config.get("heartbeat_seconds", 60)
+RUN_LOCK_ON_CONFLICT = run_lock_config.get("on_conflict", RUN_LOCK_ON_CONFLICT_EXIT)
+if RUN_LOCK_ON_CONFLICT not in (RUN_LOCK_ON_CONFLICT_EXIT, RUN_LOCK_ON_CONFLICT_UNLEASED):
+    print(f"Error: Unsupported run_lock on_conflict '{RUN_LOCK_ON_CONFLICT}' in config. Use '{RUN_LOCK_ON_CONFLICT_EXIT}' or '{RUN_LOCK_ON_CONFLICT_UNLEASED}'.")
+    exit(1)
+work_queue_config = gemini_config.get("work_queue", {})
+WORK_QUEUE_ENABLED = work_queue_config.get("enabled", False)
+WORK_QUEUE_LEASE_FOLDER_PATH = work_queue_config.get("lease_folder_path", f"{os.path.dirname(STATE_DROPBOX_PATH_BASE)}/leases")
+WORK_QUEUE_LEASE_SECONDS = work_queue_config.get("lease_seconds", 900)
+WORK_QUEUE_HEARTBEAT_SECONDS = work_queue_config.get("heartbeat_seconds", 60)
+rate_limits_config = gemini_config.get("rate_limits", {})
+RATE_LIMIT_GEMINI_VIDEO_PART_TOKENS = rate_limits_config.get(REMOTE_API_GEMINI, {}).get("video_part_tokens", DEFAULT_GEMINI_VIDEO_PART_TOKENS)
+rate_limiters = {
+    api: ApiRateLimiter(api, rate_limits_config.get(api, {}).get("requests_per_minute"), rate_limits_config.get(api, {}).get("tokens_per_minute"))
+    for api in (REMOTE_API_GEMINI, REMOTE_API_DROPBOX)
+}
+retry_config = gemini_config.get("retry", {})
+RETRY_MAX_ATTEMPTS = retry_config.get("max_attempts", 6)
+RETRY_BASE_DELAY_SECONDS = retry_config.get("base_delay_seconds", 1)
+RETRY_MAX_DELAY_SECONDS = retry_config.get("max_delay_seconds", 60)
+RETRY_DEADLINE_SECONDS = retry_config.get("deadline_seconds", 600)
+RETRY_ATTEMPT_TIMEOUT_SECONDS = retry_config.get("attempt_timeout_seconds", 300)
+circuit_breaker_config = gemini_config.get("circuit_breaker", {})
+CIRCUIT_BREAKER_ENABLED = circuit_breaker_config.get("enabled", True)
+circuit_breakers = {
+    # A disabled breaker never reaches its threshold. Saved states are restored once the state backend is reachable.
+    api: CircuitBreaker(api, circuit_breaker_config.get("failure_threshold", 5) if CIRCUIT_BREAKER_ENABLED else float('inf'),
+                        circuit_breaker_config.get("open_seconds", 120))
+    for api in (REMOTE_API_GEMINI, REMOTE_API_DROPBOX)
+}
+concurrency_config = gemini_config.get("concurrency", {})
+CONCURRENCY_ADDITIVE_INCREASE = concurrency_config.get("additive_increase", 1)
+CONCURRENCY_DECREASE_FACTOR = concurrency_config.get("decrease_factor", 0.5)
+CONCURRENCY_LATENCY_SPIKE_FACTOR = concurrency_config.get("latency_spike_factor", 3)
+CONCURRENCY_MIN_LATENCY_SAMPLES = concurrency_config.get("min_latency_samples", 5)
+concurrency_limits = {} # Learned limits are restored once the state backend is reachable
+for api, default_limits in ((REMOTE_API_GEMINI, (4, 1, 16)), (REMOTE_API_DROPBOX, (8, 1, 32))):
+    api_concurrency_config = concurrency_config.get(api, {})
+    min_limit = api_concurrency_config.get("min", default_limits[1])
+    max_limit = api_concurrency_config.get("max", default_limits[2])
+    initial_limit = api_concurrency_config.get("initial", default_limits[0])
+    concurrency_limits[api] = AdaptiveConcurrencyLimit(api, initial_limit, min_limit, max_limit)
+section_repair_config = gemini_config.get("section_repair", {})
+SECTION_REPAIR_ENABLED = section_repair_config.get("enabled", True)
+SECTION_REPAIR_MAX_ATTEMPTS = section_repair_config.get("max_attempts", 1)
+if OUTPUT_FORMAT not in (OUTPUT_FORMAT_MARKDOWN, OUTPUT_FORMAT_JSON):
+    print(f"Error: Unsupported output_format '{OUTPUT_FORMAT}' in config. Use '{OUTPUT_FORMAT_MARKDOWN}' or '{OUTPUT_FORMAT_JSON}'.")
+    exit(1)
+
+if OUTPUT_FORMAT == OUTPUT_FORMAT_JSON:
+    final_prompt_string += JSON_OUTPUT_PROMPT_SUFFIX
+    raw_gen_config = dict(raw_gen_config, response_mime_type="application/json", response_schema=DESCRIPTION_RESPONSE_SCHEMA)
 
 # Create GenerationConfig object
 try:
     GEMINI_GENERATION_CONFIG = GenerationConfig(**raw_gen_config)
     print(f"Using Gemini model: {GEMINI_MODEL_NAME}")
+    print(f"Using output format: {OUTPUT_FORMAT}")
+    # The transcript pass always produces plain text, independent of the description output format
+    TRANSCRIPT_GENERATION_CONFIG = GenerationConfig(**transcript_cache_config.get("generation_config", {"temperature": 0.0}))
+    print(f"Transcript cache: {'enabled' if TRANSCRIPT_CACHE_ENABLED else 'disabled'}")
     print(f"Using Generation Config: {GEMINI_GENERATION_CONFIG}")
     print(f"Using Processing Timeout: {PROCESSING_TIMEOUT_SECONDS} seconds")
 except Exception as e:
@@ -173,7 +3597,7 @@ except Exception as e:
 
 # Build the Dropbox API client
 try:
-    dbx = dropbox.Dropbox(DROPBOX_ACCESS_TOKEN)
+    dbx = RateLimitedDropbox(DROPBOX_ACCESS_TOKEN)
     dbx.users_get_current_account()
     print("Successfully connected to Dropbox API.")
 except dropbox.exceptions.AuthError:
@@ -183,28 +3607,74 @@ except Exception as e:
      print(f"An unexpected error occurred during initial Dropbox connection: {e}")
      exit(1)
 
-# --- State Management (remains the same) ---
+# --- State Management ---
 LOCAL_OUTPUT_DIR = 'output'
 os.makedirs(LOCAL_OUTPUT_DIR, exist_ok=True)
-PROCESSED_FILES_STATE_FILE = 'processed_files.json'
-processed_file_paths = set()
-
-if os.path.exists(PROCESSED_FILES_STATE_FILE):
+state_rev = None
+if STATE_BACKEND == STATE_BACKEND_DROPBOX:
+    try:
+        state_rev = pull_state_from_dropbox(dbx, STATE_DROPBOX_PATH, STATE_DB_FILE)
+    except Exception as e:
+        print(f"Error loading state database from Dropbox '{STATE_DROPBOX_PATH}': {e}")
+        exit(1)
+state_store = StateStore(STATE_DB_FILE, STATE_JOURNAL_FILE if STATE_BACKEND == STATE_BACKEND_DROPBOX else None)
+state_journal_segments = []
+if STATE_BACKEND == STATE_BACKEND_DROPBOX:
+    try:
+        state_journal_segments = pull_journal_from_dropbox(dbx, STATE_JOURNAL_FOLDER_PATH, state_store)
+    except Exception as e:
+        print(f"Error loading state journal from Dropbox '{STATE_JOURNAL_FOLDER_PATH}': {e}")
+        exit(1)
+print(f"Opened state store '{STATE_DB_FILE}' ({state_store.count()} jobs).")
+load_concurrency_limits()
+if CIRCUIT_BREAKER_ENABLED:
+    load_circuit_breakers()
+if SHARD_COUNT > 1:
+    print(f"Handling shard {SHARD_INDEX}/{SHARD_COUNT} of the watch folder.")
+if state_store.count() == 0 and os.path.exists(PROCESSED_FILES_STATE_FILE):
     try:
         with open(PROCESSED_FILES_STATE_FILE, 'r') as f:
-            processed_file_paths = set(json.load(f))
-        print(f"Loaded {len(processed_file_paths)} processed file paths from state file.")
+            legacy_paths = json.load(f)
+        state_store.import_legacy_paths(legacy_paths)
+        print(f"Imported {len(legacy_paths)} processed file paths from legacy {PROCESSED_FILES_STATE_FILE}.")
     except (json.JSONDecodeError, Exception) as e:
-        print(f"Warning: Error loading {PROCESSED_FILES_STATE_FILE}: {e}. Starting with empty processed list.")
-        processed_file_paths = set()
-else:
-    print(f"No {PROCESSED_FILES_STATE_FILE} found. Starting with empty processed list.")
+        print(f"Warning: Error importing legacy {PROCESSED_FILES_STATE_FILE}: {e}.")
+
+published_output_hashes = {} # Lowercased output path -> Dropbox content_hash, from this run's output listing and commits
+hedges_fired_this_run = 0
+input_path_latencies = {}
+hedges_won_this_run = 0
+STAMP_PROPERTY_TEMPLATE_ID = get_stamp_property_template_id(dbx)
+work_queue = None
+if WORK_QUEUE_ENABLED:
+    work_queue = WorkQueue(dbx, WORK_QUEUE_LEASE_FOLDER_PATH, CLI_ARGS.worker_id or f"{socket.gethostname()}-{os.getpid()}",
+                           WORK_QUEUE_LEASE_SECONDS, WORK_QUEUE_HEARTBEAT_SECONDS)
+    work_queue.start_heartbeat()
+    print(f"Work queue enabled: leasing videos as worker '{work_queue.owner}' ({WORK_QUEUE_LEASE_SECONDS}s leases, heartbeat every {WORK_QUEUE_HEARTBEAT_SECONDS}s).")
 
 print(f"Starting Dropbox watcher and processor ({POLLING_INTERVAL_DESCRIPTION}).")
 print(f"Watching Dropbox folder: {DROPBOX_WATCH_FOLDER_PATH}")
 print(f"Uploading results to Dropbox folder: {DROPBOX_OUTPUT_FOLDER_PATH}")
 
+run_lock = None
+lane_scheduler = None
+video_cost_estimates = {} # Dropbox file id -> estimated processing seconds
 try:
+    if CLI_ARGS.command == "status":
+        print_shard_status_report(CLI_ARGS.shards or SHARD_COUNT)
+        exit(0)
+
+    if RUN_LOCK_ENABLED:
+        run_lock = RunLock(dbx, RUN_LOCK_PATH, work_queue.owner if work_queue else f"{socket.gethostname()}-{os.getpid()}",
+                           RUN_LOCK_TTL_SECONDS, RUN_LOCK_HEARTBEAT_SECONDS)
+        if run_lock.acquire():
+            print(f"Acquired run lock '{RUN_LOCK_PATH}' (TTL {RUN_LOCK_TTL_SECONDS}s).")
+        elif RUN_LOCK_ON_CONFLICT == RUN_LOCK_ON_CONFLICT_UNLEASED and work_queue:
+            print(f"Another run ({run_lock.holder.get('owner')}) holds the run lock. Continuing with videos it has not leased.")
+        else:
+            print(f"Another run ({run_lock.holder.get('owner')}) holds the run lock until {datetime.utcfromtimestamp(run_lock.holder.get('expires_at', 0)).isoformat()} UTC. Exiting.")
+            exit(0)
+
     # Check if watch folder exists and is accessible
     try:
         dbx.files_get_metadata(DROPBOX_WATCH_FOLDER_PATH)
@@ -223,278 +3693,101 @@ try:
 
     # List files in the Dropbox watch folder
     print(f"Listing files in '{DROPBOX_WATCH_FOLDER_PATH}'...")
-    result = dbx.files_list_folder(path=DROPBOX_WATCH_FOLDER_PATH, recursive=False)
-    entries = result.entries
+    # Lanes and tenants may map subfolders of the watch folder, so the listing is recursive when they are enabled
+    entries = list_dropbox_folder(dbx, DROPBOX_WATCH_FOLDER_PATH, recursive=PRIORITY_LANES_ENABLED or TENANTS_ENABLED)
     print(f"Found {len(entries)} entries in the watch folder.")
+    if SHARD_COUNT > 1:
+        entries = [entry for entry in entries if not isinstance(entry, dropbox.files.FileMetadata) or in_this_shard(entry)]
+        print(f"{len(entries)} of them belong to shard {SHARD_INDEX}/{SHARD_COUNT}.")
+
+    publish_batch = DropboxPublishBatch(dbx, DROPBOX_PUBLISH_BATCH_WINDOW_SECONDS, DROPBOX_PUBLISH_BATCH_MAX_ENTRIES)
+
+    # Reconcile against the output folder: one listing per run tells us which descriptions already exist
+    print(f"Listing published descriptions in '{DROPBOX_OUTPUT_FOLDER_PATH}'...")
+    output_entries = list_output_folder(dbx)
+    published_outputs = reconcile_published_outputs(output_entries)
+    print(f"Found {len(published_outputs)} published description(s) in the output folder.")
+
+    if CLI_ARGS.command == "reprocess":
+        reprocess_stale_descriptions(
+            dbx, publish_batch, entries, output_entries,
+            CLI_ARGS.limit if CLI_ARGS.limit is not None else REPROCESS_MAX_VIDEOS_PER_RUN,
+            CLI_ARGS.min_interval if CLI_ARGS.min_interval is not None else REPROCESS_MIN_INTERVAL_SECONDS,
+        )
+        exit(0)
 
-    files_to_process_now = []
     time_threshold = datetime.utcnow() - timedelta(days=1)
     print(f"Processing files modified since (UTC): {time_threshold.isoformat()}")
-
-    for entry in entries:
-        if isinstance(entry, dropbox.files.FileMetadata) and hasattr(entry, 'server_modified') and isinstance(entry.server_modified, datetime) and entry.server_modified.replace(tzinfo=None) > time_threshold:
-            if is_video_file(entry.name):
-                 if entry.path_display not in processed_file_paths:
-                      print(f"Identified new/unprocessed video file: {entry.path_display} (Modified: {entry.server_modified})")
-                      files_to_process_now.append(entry)
-                 else:
-                      print(f"Skipping already processed video file: {entry.path_display} (Already in local list)")
-        elif isinstance(entry, dropbox.files.FileMetadata):
-             print(f"Skipping old or invalid metadata file: {entry.path_display} (Modified: {getattr(entry, 'server_modified', 'N/A')})")
-
+    files_to_process_now = find_videos_to_process(entries, published_outputs, time_threshold)
     print(f"Found {len(files_to_process_now)} video files requiring processing in this run.")
-
-    # Process the identified video files one by one
-    for file_entry in files_to_process_now:
-        dropbox_watch_file_path = file_entry.path_display
-        file_name = file_entry.name
-        local_temp_video_path = os.path.join(LOCAL_OUTPUT_DIR, f"temp_video_{file_entry.id.replace('id:', '')}_{file_name}")
-
-        print(f"\n--- Processing {file_name} ---")
-
-        if download_file_from_dropbox(dbx, dropbox_watch_file_path, local_temp_video_path):
-            file_obj = None
-
-            try:
-                print("Uploading video to Gemini API...")
-                mime_type_to_use = None
-                guessed_mime_type, _ = mimetypes.guess_type(file_name)
-                if guessed_mime_type and 'video/' in guessed_mime_type:
-                    mime_type_to_use = guessed_mime_type
-                    print(f"Guessed MIME type from extension: {mime_type_to_use}")
-                else:
-                    print(f"Warning: Could not determine confident video MIME type for {file_name} from extension. Proceeding without explicit MIME type (Gemini might reject).")
-
-                file_obj = genai.upload_file(
-                    path=local_temp_video_path,
-                    display_name=file_name,
-                    mime_type=mime_type_to_use
-                )
-                print(f"Uploaded file to Gemini: {file_obj.uri}, State: {file_obj.state}")
-
-                print("Waiting for Gemini processing...")
-                processing_start_time = time.time()
-
-                # Use raw integer state values for robustness
-                succeeded_state_value = 2
-                failed_state_value = 3
-                cancelled_state_value = 4
-                terminal_state_values_numeric = [succeeded_state_value, failed_state_value, cancelled_state_value]
-
-                while file_obj.state not in terminal_state_values_numeric:
-                    if not file_obj or not hasattr(file_obj, 'name'):
-                         print("Error: Gemini file_obj is invalid during wait loop.")
-                         raise RuntimeError("Gemini file object invalid during wait loop.")
-
-                    if time.time() - processing_start_time > PROCESSING_TIMEOUT_SECONDS:
-                         print(f"Gemini processing timed out after {PROCESSING_TIMEOUT_SECONDS} seconds for {file_name}. Current state: {file_obj.state}")
-                         if file_obj and hasattr(file_obj, 'name'):
-                             try: genai.delete_file(file_obj.name)
-                             except Exception as delete_e: print(f"Error deleting timed-out Gemini file {file_obj.name}: {delete_e}")
-                         raise TimeoutError(f"Gemini processing timed out for {file_name}. Current state: {file_obj.state}")
-
-                    time.sleep(15)
-
-                    try:
-                        file_obj = genai.get_file(file_obj.name)
-                    except Exception as get_file_e:
-                         print(f"Warning: Error getting Gemini file status for {file_obj.name}: {get_file_e}. Retrying status check...")
-                         continue
-
-                    print(f"  ... State: {file_obj.state}, Elapsed: {int(time.time() - processing_start_time)}s")
-
-                if file_obj.state == succeeded_state_value:
-                    print(f"Gemini processing succeeded for {file_name}.")
-                elif file_obj.state == failed_state_value:
-                    error_message = file_obj.error.message if hasattr(file_obj, 'error') and file_obj.error else 'N/A'
-                    print(f"Gemini processing failed for {file_name}. State: {file_obj.state}, Error: {error_message}")
-                    try: genai.delete_file(file_obj.name)
-                    except Exception as delete_e: print(f"Error deleting failed Gemini file: {delete_e}")
-                    raise RuntimeError(f"Gemini processing failed: {file_obj.state} - {error_message}")
-                elif file_obj.state == cancelled_state_value:
-                     print(f"Gemini processing was cancelled for {file_name}. State: {file_obj.state}")
-                     try: genai.delete_file(file_obj.name)
-                     except Exception as delete_e: print(f"Error deleting cancelled Gemini file: {delete_e}")
-                     raise RuntimeError(f"Gemini processing was cancelled: {file_obj.state}")
-
-                # --- Generate content with Gemini ---
-                print("Generating content with Gemini using template, example, and video...")
-                model = genai.GenerativeModel(GEMINI_MODEL_NAME)
-
-                try:
-                    response = model.generate_content(
-                        [final_prompt_string, file_obj],
-                        generation_config=GEMINI_GENERATION_CONFIG
-                    )
-
-                    response_text = None
-                    content_blocked = False # Flag to track if content was blocked by safety filters
-
-                    if response and hasattr(response, 'candidates') and response.candidates:
-                         candidate = response.candidates[0]
-
-                         # --- Check finish reason - often indicates filtering ---
-                         # Use string comparison for robustness across library versions
-                         if hasattr(candidate, 'finish_reason'):
-                              finish_reason_str = str(candidate.finish_reason) # Convert Enum to string
-                              print(f"Candidate finish reason: {finish_reason_str}")
-                              # Common finish reasons for filtering include SAFETY, RECITATION, OTHER
-                              if 'SAFETY' in finish_reason_str or 'RECITATION' in finish_reason_str:
-                                   print("Candidate finished due to safety or recitation policy.")
-                                   content_blocked = True
-                                   # Log safety ratings if available, for detail
-                                   if hasattr(candidate, 'safety_ratings') and candidate.safety_ratings:
-                                        print("Safety ratings:")
-                                        for rating in candidate.safety_ratings:
-                                             # Check if probability is AT_LEAST_MEDIUM or higher (usually indicates potential issue)
-                                             # Value 4=AT_LEAST_MEDIUM, 5=HARM_BLOCKED (for probability Enum)
-                                             prob_value = rating.probability # This is an Enum value
-                                             print(f"  - {rating.category}: {prob_value} (Probability Enum Value)")
-                                             if prob_value >= 4: # Check against Enum value >= AT_LEAST_MEDIUM
-                                                 print("    (Likely blocked due to high probability)")
-
-
-                         # --- If not blocked by finish reason, check individual ratings more thoroughly ---
-                         # This catches cases where finish_reason isn't explicitly safety but ratings are high
-                         if not content_blocked and hasattr(candidate, 'safety_ratings') and candidate.safety_ratings:
-                              print("Checking individual safety ratings (second pass)...")
-                              for rating in candidate.safety_ratings:
-                                   prob_value = rating.probability # This is an Enum value
-                                   if prob_value >= 4: # Check if probability is AT_LEAST_MEDIUM or higher
-                                       print(f"  - {rating.category}: {prob_value} (Probability Enum Value) (Potential block indicated)")
-                                       content_blocked = True # Mark as blocked if any rating is AT_LEAST_MEDIUM or higher
-                              if content_blocked:
-                                  print("Content marked as blocked due to high safety rating probabilities.")
-
-
-                         # --- If not blocked, attempt to extract text ---
-                         if not content_blocked and hasattr(candidate, 'content') and candidate.content and hasattr(candidate.content, 'parts') and candidate.content.parts:
-                             try:
-                                 response_text = ''.join(p.text for p in candidate.content.parts if hasattr(p, 'text'))
-                                 # Check for minimal text length - if text is super short, maybe it's also a form of filtering or failed generation
-                                 if response_text and len(response_text.strip()) < 50: # Require at least 50 characters for valid content
-                                      print(f"Warning: Generated text is very short ({len(response_text.strip())} chars), possibly incomplete or minimal output.")
-                                      # Treat minimal text as blocked for saving/uploading purposes, but don't raise error
-                                      content_blocked = True # Treat as blocked so it doesn't save the empty/minimal markdown
-                                      response_text = None # Clear the text so it goes to the 'else' block
-
-
-                             except Exception as text_extract_e:
-                                 print(f"Warning: Error extracting text from response parts: {text_extract_e}")
-                                 response_text = None # Ensure None if extraction fails
-
-
-                    # Decision point: Save/Upload only if content was not blocked AND valid text was extracted
-                    if response_text and not content_blocked:
-                        base_name = os.path.splitext(file_name)[0]
-                        output_md_local_path = os.path.join(LOCAL_OUTPUT_DIR, f"{base_name}.md")
-                        output_html_local_path = os.path.join(LOCAL_OUTPUT_DIR, f"{base_name}.html")
-
-                        with open(output_md_local_path, "w", encoding='utf-8') as f:
-                            f.write(response_text)
-                        print(f"Saved markdown locally: {output_md_local_path}")
-
-                        # Ensure markdown conversion doesn't fail on unexpected short strings
-                        upload_success_html = True # Assume success unless conversion/upload fails
-                        try:
-                            html_content = markdown.markdown(response_text)
-                            with open(output_html_local_path, "w", encoding='utf-8') as f:
-                                f.write(html_content)
-                            print(f"Saved HTML locally: {output_html_local_path}")
-                        except Exception as md_convert_e:
-                             print(f"Error converting markdown to HTML for {file_name}: {md_convert_e}")
-                             upload_success_html = False # HTML conversion failed
-
-                        print("Attempting to upload results to Dropbox...")
-                        dropbox_md_target_path = os.path.join(DROPBOX_OUTPUT_FOLDER_PATH, f"{base_name}.md")
-                        dropbox_html_target_path = os.path.join(DROPBOX_OUTPUT_FOLDER_PATH, f"{base_name}.html")
-
-                        upload_success_md = upload_file_to_dropbox(dbx, output_md_local_path, dropbox_md_target_path)
-
-                        # Only attempt HTML upload if conversion was successful
-                        if upload_success_html:
-                             upload_success_html = upload_file_to_dropbox(dbx, output_html_local_path, dropbox_html_target_path)
-                        else:
-                             # If HTML conversion failed, set upload status to False
-                             upload_success_html = False
-
-
-                        if upload_success_md and upload_success_html:
-                            print(f"Successfully uploaded both results for {file_name} to Dropbox.")
-                            processed_file_paths.add(dropbox_watch_file_path)
-                            print(f"Marked '{dropbox_watch_file_path}' as processed (for this run).")
-                        elif upload_success_md:
-                             print(f"Successfully uploaded Markdown only for {file_name} (HTML upload failed). NOT marking as fully processed in this run.")
-                        else:
-                            print(f"Upload failed for one or both output files for {file_name}. NOT marking as fully processed in this run.")
-
-
-                    else: # Handle case where response_text is None or content was blocked
-                        if content_blocked:
-                             print(f"Skipping saving/uploading for {file_name} due to content blocking or minimal output.")
-                             # Decide if you want to treat a blocked response as 'processed' or retry
-                             # processed_file_paths.add(dropbox_watch_file_path) # Uncomment to mark blocked as processed
-                             # print(f"Marked '{dropbox_watch_file_path}' as processed (blocked).")
-                        else: # This covers cases where response_text is None for other reasons (e.g. extraction error)
-                             print(f"Gemini generated empty or invalid text content for {file_name} (not explicitly blocked). No output files generated.")
-
-                        # Clean up Gemini file object if it exists and wasn't deleted by failed processing check
-                        if file_obj and hasattr(file_obj, 'name'):
-                            try: genai.delete_file(file_obj.name)
-                            except Exception as delete_e: print(f"Error deleting Gemini file {file_obj.name} after empty/blocked response: {delete_e}")
-
-
-                except Exception as content_gen_e:
-                    print(f"Error during Gemini content generation process for {file_name}: {content_gen_e}")
-                    # Don't mark as processed
-                    # Clean up Gemini file object if it exists and wasn't deleted by failed processing check
-                    if file_obj and hasattr(file_obj, 'name'):
-                         try: genai.delete_file(file_obj.name)
-                         except Exception as delete_e: print(f"Error deleting Gemini file {file_obj.name} after generation error: {delete_e}")
-
-
-            except Exception as gemini_process_e:
-                 # This catches errors during Gemini upload or the waiting loop
-                 print(f"Error during Gemini upload or waiting for processing for {file_name}: {gemini_process_e}")
-                 # Don't mark as processed
-                 # Clean up the file uploaded to Gemini if it failed during Gemini processing/wait
-                 if file_obj and hasattr(file_obj, 'name'):
-                     try:
-                         genai.delete_file(file_obj.name)
-                         print(f"Deleted Gemini file {file_obj.name} after Gemini processing/wait error.")
-                     except Exception as delete_e:
-                         print(f"Error deleting Gemini file {file_obj.name} after processing/wait error: {delete_e}")
-
-            finally:
-                # --- Cleanup ---
-                # Clean up the local temporary video file
-                if os.path.exists(local_temp_video_path):
-                    try: os.remove(local_temp_video_path)
-                    except OSError as e: print(f"Error removing temporary local file {local_temp_video_path}: {e}")
-
-                # Clean up local output files after attempted upload - Check if they exist before trying to remove
-                base_name = os.path.splitext(file_name)[0]
-                output_md_local_path_potential = os.path.join(LOCAL_OUTPUT_DIR, f"{base_name}.md")
-                output_html_local_path_potential = os.path.join(LOCAL_OUTPUT_DIR, f"{base_name}.html")
-                if os.path.exists(output_md_local_path_potential):
-                   try: os.remove(output_md_local_path_potential)
-                   except OSError as e: print(f"Error removing local file {output_md_local_path_potential}: {e}")
-                if os.path.exists(output_html_local_path_potential):
-                   try: os.remove(output_html_local_path_potential)
-                   except OSError as e: print(f"Error removing local file {output_html_local_path_potential}: {e}")
-                print("Cleaned up local temporary files.")
-
-        else:
-            print(f"Skipping processing for {file_name} due to download failure from Dropbox.")
-            # Don't mark as processed so it can be retried
-
-    print(f"\nSaving updated processed file list locally ({len(processed_file_paths)} entries)...")
-    try:
-        with open(PROCESSED_FILES_STATE_FILE, 'w') as f:
-            json.dump(list(processed_file_paths), f)
-        print(f"Successfully saved processed file list locally ({PROCESSED_FILES_STATE_FILE}). Note: This file is NOT persisted across runs without GitHub Actions Artifacts.")
-    except Exception as e:
-        print(f"Error saving processed file list locally to {PROCESSED_FILES_STATE_FILE}: {e}")
+    lane_scheduler = LaneScheduler(PRIORITY_LANES, TENANTS, schedule_videos(files_to_process_now))
+    if PRIORITY_LANES_ENABLED:
+        print(f"Queued per lane: {', '.join(f'{name}: {count}' for name, count in lane_scheduler.queue_lengths().items())}")
+    last_urgent_poll_time = time.time()
+
+    # Process the identified video files one by one, picking the next one across the priority lanes
+    # Outputs are staged per video and committed to Dropbox in batches (every batch window and at the end)
+    published_paths = []
+    while True:
+        file_entry = lane_scheduler.next_video()
+        if file_entry is None:
+            break
+        unavailable = unavailable_backends()
+        if unavailable:
+            # Every video needs both backends, so nothing is downloaded or uploaded during an outage
+            print(f"Skipping {file_entry.name}: circuit breaker open for {', '.join(unavailable)}. It stays queued for a later run.")
+            if work_queue and work_queue.holds(file_entry):
+                work_queue.release(file_entry)
+            lane_scheduler.finish(file_entry)
+            continue
+        if work_queue and not work_queue.holds(file_entry) and not work_queue.claim(file_entry):
+            # Another runner has it; free the tenant's Gemini job slot taken by next_video()
+            lane_scheduler.finish(file_entry)
+            continue
+        try:
+            with remote_calls_for(file_entry):
+                staged = process_video_entry(dbx, publish_batch, file_entry)
+            if not staged and work_queue:
+                # Let another worker retry it now rather than renewing the lease until the run ends
+                work_queue.release(file_entry)
+            lane_scheduler.finish(file_entry)
+        except VideoPreempted as preempted:
+            print(f"Preempting {file_entry.name} ({preempted.lane} lane) for newly arrived {preempted.urgent_lane} work. It resumes from its checkpoint later.")
+            state_store.mark_pending(file_entry)
+            lane_scheduler.requeue(file_entry)
+        except CircuitOpenError as e:
+            # The backend went down mid-video; what is already staged is still committed below
+            print(f"Stopping: {e} while processing {file_entry.name}. It resumes from its checkpoint in a later run.")
+            state_store.mark_pending(file_entry)
+            if work_queue:
+                work_queue.release(file_entry)
+            lane_scheduler.finish(file_entry)
+            break
+        except Exception:
+            if work_queue:
+                work_queue.release(file_entry)
+            raise
+        published_paths.extend(publish_batch.commit_if_due())
+    files_to_process_now = lane_scheduler.started_videos()
+    published_paths.extend(publish_batch.commit())
+    if publish_batch.skipped_count:
+        print(f"Skipped {publish_batch.skipped_count} output upload(s) whose content was unchanged in Dropbox.")
+
+    entries_by_path = {file_entry.path_display: file_entry for file_entry in files_to_process_now}
+    for published_path in published_paths:
+        mark_video_published(entries_by_path[published_path])
+        lane_scheduler.record_published(entries_by_path[published_path])
+    mark_unpublished_failed(files_to_process_now, published_paths)
+    if TENANTS_ENABLED:
+        lane_scheduler.print_tenant_metrics()
+
+    print_input_path_latency_summary()
+    print_rate_limit_summary()
+    if HEDGING_ENABLED:
+        print(f"\nHedged generation: {hedges_fired_this_run} hedge request(s) fired, {hedges_won_this_run} won.")
+
+    status_counts = state_store.status_counts()
+    print(f"\nState store: {', '.join(f'{count} {status}' for status, count in sorted(status_counts.items())) or 'no jobs'}.")
 
 except dropbox.exceptions.ApiError as e:
      print(f"\nDropbox API Error during initial folder check or listing: {e}")
@@ -508,7 +3801,7 @@ except dropbox.exceptions.ApiError as e:
               exit(1)
          else: print(f"Unhandled Dropbox Path Error during listing: {e}")
      elif e.error.is_rate_limit():
-          print(f"Dropbox Rate Limit Error during listing. Details: {e}. The job might retry depending on workflow settings.")
+          print(f"Dropbox Rate Limit Error during listing that persisted through {RETRY_MAX_ATTEMPTS} attempt(s). Details: {e}. The job might retry depending on workflow settings.")
           exit(1)
      else:
          print(f"Unhandled Dropbox API Error during listing: {e}")
@@ -517,3 +3810,16 @@ except dropbox.exceptions.ApiError as e:
 except Exception as e:
     print(f"\nAn unexpected error occurred during script execution: {e}")
     exit(1)
+
+finally:
+    # State first: a cancelled runner only gets a few seconds before it is killed. The learned limits and
+    # breaker states are settings in the store, so they ship in the same journal segment.
+    save_concurrency_limits()
+    if CIRCUIT_BREAKER_ENABLED:
+        save_circuit_breakers()
+    save_state()
+    if work_queue:
+        work_queue.shutdown()
+        checkpoint_state("releasing leases")
+    if run_lock:
+        run_lock.release()